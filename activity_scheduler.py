@@ -1,18 +1,25 @@
 import asyncio
+import heapq
+import time
 from abc import ABC, abstractmethod
-import random
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
 from telegram import Bot
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from helper import *
-from app.lottery_activity_handler.data_class import Activity, ActivityStatus
-from app.lottery_activity_handler.data_repository import IDataRepository, InMemoryRepository
+from app.lottery_activity_handler.data_class import Activity, ActivityStatus, ParticipantColumns
+from app.lottery_activity_handler.data_repository import IDataRepository, InMemoryRepository, CachedRepository, ConditionStatusWriter
 from app.lottery_activity_handler.message_format import InMessageFormat
 from app.lottery_activity_handler.validator import *
+from app.lottery_activity_handler.speech_count import speech_count_engine, speech_counter_store
 from app.lottery_activity_handler.data_class import LotteryBot
+from app.lottery_activity_handler.coordinator import ISchedulerCoordinator, StandaloneCoordinator
+from app.lottery_activity_handler.bot_pool import bot_pool
+from app.lottery_activity_handler.draw_engine import DrawEngine
+from app.lottery_activity_handler.eligibility import EligibilityEngine
+from app.lottery_activity_handler.verification import verification_tracker
 from app.lottery_activity_handler.logger_handler import app_logger
 
 
@@ -23,27 +30,50 @@ class IPrizesChoice(ABC):
         pass
     
 class ActivityPrizesChoice(IPrizesChoice):
-    async def random_choice_prizer(self, data_repository: IDataRepository, prezes_list: list, activity_detail_list: list) -> None:
-        activity_detail_list_copy = activity_detail_list.copy()
+    async def random_choice_prizer(self, data_repository: IDataRepository, prezes_list: list, activity_detail_list: list, engine: DrawEngine = None,
+                                   weighers: Dict[str, Callable] = None) -> None:
+        """一次洗牌按奖品等级依次分配中奖用户，种子记录在日志里用于复核；
+        奖品配置了 weight_by 时该奖项按 weighers[weight_by](用户) 的权重用别名表不放回抽样"""
+        engine = engine or DrawEngine()
+        activity_id = activity_detail_list[0].activity_id if activity_detail_list else None
+        app_logger.info(f"抽奖开始 activity_id: {activity_id}, seed: {engine.seed}, 候选人: {len(activity_detail_list)} 个")
+        counts = [prize.prize_count for prize in prezes_list]
+        if any(prize.weight_by for prize in prezes_list):
+            tiers = self._weighted_tiers(engine, prezes_list, activity_detail_list, weighers or {})
+        else:
+            tiers = engine.draw(len(activity_detail_list), counts)
+        winners = []
     
-        for index, prize in enumerate(prezes_list, start=1):
-            if not activity_detail_list_copy:
+        for index, (prize, picked) in enumerate(zip(prezes_list, tiers), start=1):
+            if not picked:
+                app_logger.info("候选人已抽完")
                 break
-                
-            # 随机取出元素
-            taken = random.sample(activity_detail_list_copy, min(prize.prize_count, len(activity_detail_list_copy)))
-            
-            # 从列表中移除已取的元素
-            for item in taken:
-                activity_detail_list_copy.remove(item)
-                
+            taken = [activity_detail_list[i] for i in picked]
             for user in taken:
-                await data_repository.update_prize_user(prize.prize_name + " " + prize.prize_content, user.id, index)
-            app_logger.info(f"取出 {len(taken)} 个元素: {taken}, 剩余: {len(activity_detail_list_copy)} 个")
-            
-            if not activity_detail_list_copy:
-                app_logger.info("列表2已清空")
-                break
+                winners.append((user.id, prize.prize_name + " " + prize.prize_content, index))
+            app_logger.info(f"奖项 {index} 抽出 {len(taken)} 个: {[user.user_id for user in taken]}")
+        
+        # 所有奖项抽完后一次性写入
+        if winners:
+            await data_repository.record_winners(activity_id, winners)
+    
+    @staticmethod
+    def _weighted_tiers(engine: DrawEngine, prezes_list: list, activity_detail_list: list, weighers: Dict[str, Callable]) -> List[List[int]]:
+        """每种权重只建一次别名表，各奖项共用已中奖集合"""
+        taken = set()
+        samplers = {}
+        tiers = []
+        for prize in prezes_list:
+            weight_by = prize.weight_by if prize.weight_by in weighers else ""
+            if prize.weight_by and not weight_by:
+                app_logger.warning(f"不支持的中奖权重 weight_by: {prize.weight_by}, 按等概率抽取")
+            sampler = samplers.get(weight_by)
+            if sampler is None:
+                weigh = weighers.get(weight_by)
+                weights = [weigh(user) for user in activity_detail_list] if weigh else [1.0] * len(activity_detail_list)
+                sampler = samplers[weight_by] = engine.weighted_sampler(weights, taken)
+            tiers.append(sampler.pick(prize.prize_count))
+        return tiers
 
 class INotificationService(ABC):
     """通知服务接口"""
@@ -55,48 +85,99 @@ class INotificationService(ABC):
     @abstractmethod
     async def send_activity_end_notification(self, activity: Activity, chat_id: str) -> None:
         pass
+    
+    @abstractmethod
+    async def render_start_notification(self, activity: Activity) -> dict:
+        pass
+    
+    @abstractmethod
+    async def render_end_notification(self, activity: Activity) -> dict:
+        pass
+    
+    @abstractmethod
+    async def send_rendered(self, activity: Activity, chat_id: str, rendered: dict) -> None:
+        pass
 
 
 class TelegramNotificationService(INotificationService):
     """Telegram通知服务"""
+    
+    def __init__(self, repository: IDataRepository = None):
+        self.repository = repository or InMemoryRepository()
+    
+    async def render_start_notification(self, activity: Activity) -> dict:
+        """渲染活动开始通知（文案和按钮），同一活动所有群共用"""
+        mesage_format = InMessageFormat(activity, self.repository)
+        content = await mesage_format.start_notification()
+        
+        lottery_bot = await LotteryBot.get_lottery_bot(activity.sys_user_id)
+        bot_username = lottery_bot["username"].replace("@", "")
+        
+        keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🤖 参与抽奖", url=f"https://t.me/{bot_username}")]
+        ])
+        return {"text": content, "reply_markup": keyboard}
+    
+    async def render_end_notification(self, activity: Activity) -> dict:
+        """渲染活动结束通知（含中奖名单），同一活动所有群共用"""
+        mesage_format = InMessageFormat(activity, self.repository)
+        content = await mesage_format.end_notification()
+        return {"text": content, "reply_markup": None}
+    
+    async def send_rendered(self, activity: Activity, chat_id: str, rendered: dict) -> None:
+        """用群里的机器人发送已渲染的通知，失败直接抛出由调用方统计"""
+        bot = await LotteryBot.get_first_bot(chat_id, "join_group", activity.sys_user_id)
+        await bot.send_message(chat_id=chat_id, **rendered)
+    
     async def send_activity_start_notification(self, activity: Activity, chat_id: str) -> None:
         """发送活动开始通知"""
         try:
-            
-            bot = await LotteryBot.get_first_bot(chat_id, "join_group", activity.sys_user_id)
-            app_logger.info(f"发送活动开始通知 参数: activity: {activity}, chat_id: {chat_id}, first_bot: {bot}")
-            repository = InMemoryRepository()
-            mesage_format = InMessageFormat(activity, repository)
-            content = await mesage_format.start_notification()
-            
-            lottery_bot = await LotteryBot.get_lottery_bot(activity.sys_user_id)
-            bot_username = lottery_bot["username"].replace("@", "")
-            
-            keyboard = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🤖 参与抽奖", url=f"https://t.me/{bot_username}")]
-            ])
-            
-            await bot.send_message(
-                chat_id=chat_id,
-                text=content,
-                reply_markup=keyboard
-            )
+            app_logger.info(f"发送活动开始通知 参数: activity: {activity}, chat_id: {chat_id}")
+            rendered = await self.render_start_notification(activity)
+            await self.send_rendered(activity, chat_id, rendered)
         except Exception as e:
             app_logger.error(f"发送活动开始通知异常: {e}", exc_info=True)
         
     
-    async def send_activity_end_notification(self, activity: Activity, chat_id: str, repository: IDataRepository) -> None:
+    async def send_activity_end_notification(self, activity: Activity, chat_id: str, repository: IDataRepository = None) -> None:
         """发送活动结束通知"""
         try:
-            repository = InMemoryRepository()
-            mesage_format = InMessageFormat(activity, repository)
-            content = await mesage_format.end_notification()
-            
-            bot = await LotteryBot.get_first_bot(chat_id, "join_group", activity.sys_user_id)
-            await bot.send_message(chat_id=chat_id, text=content)
+            rendered = await self.render_end_notification(activity)
+            await self.send_rendered(activity, chat_id, rendered)
         except Exception as e:
             app_logger.error(f"发送活动结束通知异常: {e}", exc_info=True)
 
+
+class NotificationFanout:
+    """通知分发：渲染好的通知交给固定数量的worker并发发送到各群，返回每个群的发送结果"""
+    
+    def __init__(self, workers: int = 5):
+        self.workers = workers
+    
+    async def dispatch(self, chat_ids: List[str], send: Callable[[str], Awaitable[None]]) -> Dict[str, str]:
+        """results: chat_id -> "ok" 或错误信息"""
+        queue: asyncio.Queue = asyncio.Queue()
+        for chat_id in chat_ids:
+            queue.put_nowait(chat_id)
+        results: Dict[str, str] = {}
+        
+        async def worker():
+            while True:
+                try:
+                    chat_id = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                try:
+                    await send(chat_id)
+                    results[chat_id] = "ok"
+                except Exception as e:
+                    results[chat_id] = str(e)
+                    app_logger.error(f"发送通知到群组 {chat_id} 失败: {e}")
+        
+        await asyncio.gather(*[worker() for _ in range(min(self.workers, len(chat_ids)))])
+        return results
+
+
 class ISchedulerService(ABC):
     """调度服务接口"""
     
@@ -110,29 +191,50 @@ class ISchedulerService(ABC):
 
 
 class ActivityScheduler(ISchedulerService):
-    """活动调度器"""
+    """活动调度器
     
-    def __init__(self, repository: IDataRepository, notification_service: INotificationService, prizes_choice: ActivityPrizesChoice, validator: ConditionValidatorFactory):
+    按截止时间调度：最小堆里放每个活动下一次需要处理的时间（开始时间、结束前半小时检查、结束时间），
+    睡到最近的时间点再只处理到期的活动；另外定期用一条轻量查询检测活动有没有新增或修改
+    """
+    
+    CHECK_WINDOW = timedelta(seconds=1800)  # 结束前半小时开始检查
+    
+    def __init__(self, repository: IDataRepository, notification_service: INotificationService, prizes_choice: ActivityPrizesChoice, validator: ConditionValidatorFactory,
+                 poll_interval: float = 15.0, check_interval: float = 60.0, coordinator: ISchedulerCoordinator = None,
+                 check_freshness: float = 600.0, final_freshness: float = 120.0):
         self.repository = repository
         self.notification_service = notification_service
         self.prizes_choice = prizes_choice
         self.validator = validator
+        self.coordinator = coordinator or StandaloneCoordinator()  # 多节点部署时决定本节点负责哪些活动
+        self.fanout = NotificationFanout(workers=5)  # 最多同时发送5个通知
+        self.eligibility = EligibilityEngine(validator)  # 开奖时批量计算合格用户
+        self.poll_interval = poll_interval  # 检测活动变化的间隔
+        self.check_interval = check_interval  # 检查窗口内两次验证的间隔
+        self.check_freshness = check_freshness  # 检查窗口内验证结果的有效期，期间没有相关事件就不重复验证
+        self.final_freshness = final_freshness  # 开奖前验证结果的有效期
         self._running = False
         self._task = None
+        self._sweep_cursors = {}  # activity_id -> 上次验证到的 activity_user.id，用于中断后续跑
+        self._activities: Dict[int, Activity] = {}
+        self._activities_version = None
+        self._deadlines = []  # (到期时间, activity_id, 版本号)
+        self._generations: Dict[int, int] = {}  # activity_id -> 当前有效的堆条目版本号
+        self._last_run: Dict[int, datetime] = {}
+        self._inflight: Dict[int, asyncio.Task] = {}
+        self._next_sync = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._semaphore = asyncio.Semaphore(10)  # 最多同时处理10个活动
         
     
     async def task_scheduler(self) -> None:
         """启动调度器"""
         self._running = True
-        activity_scheduler = AsyncIOScheduler()
-        activity_scheduler.add_job(self._scheduler_loop, 
-                                'interval', 
-                                seconds=60, 
-                                misfire_grace_time=300,
-                                max_instances=1, 
-                                next_run_time=datetime.now())
+        self._wakeup = asyncio.Event()
+        await self.coordinator.start()
+        speech_counter_store.start()
+        self._task = asyncio.create_task(self._deadline_loop())
         app_logger.info("活动调度器已启动")
-        activity_scheduler.start()
     
     async def stop(self) -> None:
         """停止调度器"""
@@ -143,34 +245,135 @@ class ActivityScheduler(ISchedulerService):
                 await self._task
             except asyncio.CancelledError:
                 pass
+        await self.coordinator.stop()
+        await speech_counter_store.close()
+        await bot_pool.close()
         app_logger.info("活动调度器已停止")
     
+    async def _deadline_loop(self) -> None:
+        """调度循环：处理到期活动，然后睡到下一个截止时间或下一次变化检测"""
+        while self._running:
+            try:
+                if time.monotonic() >= self._next_sync:
+                    await self._sync_activities()
+                    self._next_sync = time.monotonic() + self.poll_interval
                 
-    async def _scheduler_loop(self) -> None:
-        """调度循环"""
-        try:
-            activities = await self.repository.get_all_activities()
-            
-            # 并发处理活动，但限制并发数量避免资源耗尽
-            semaphore = asyncio.Semaphore(10)  # 最多同时处理10个活动
-            tasks = [self._process_activity(activity, semaphore) for activity in activities]
-            await asyncio.gather(*tasks, return_exceptions=True)
+                now = datetime.now()
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    _, activity_id, generation = heapq.heappop(self._deadlines)
+                    if self._generations.get(activity_id) == generation:
+                        self._dispatch(activity_id)
+                
+                delay = self._next_sync - time.monotonic()
+                if self._deadlines:
+                    delay = min(delay, (self._deadlines[0][0] - datetime.now()).total_seconds())
+            except Exception as e:
+                app_logger.error(f"调度器循环执行出错: {e}", exc_info=True)
+                delay = self.poll_interval
             
-        except Exception as e:
-            app_logger.error(f"调度器循环执行出错: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+    
+    async def _sync_activities(self) -> None:
+        """活动指纹变化时重新加载活动并重建截止时间堆"""
+        version = await self.repository.get_activities_version()
+        if version == self._activities_version:
+            return
+        activities = await self.repository.get_all_activities()
+        if activities is None:
+            return
+        self._activities_version = version
+        self._activities = {activity.id: activity for activity in activities}
+        self._last_run = {activity_id: run_at for activity_id, run_at in self._last_run.items() if activity_id in self._activities}
+        self._deadlines = []
+        self._generations = {}
+        for activity in activities:
+            if activity.id not in self._inflight:
+                self._schedule(activity)
+        app_logger.info(f"活动调度器已同步活动: {len(activities)} 个, 待处理时间点: {len(self._deadlines)} 个")
+    
+    def _next_due(self, activity: Activity) -> Optional[datetime]:
+        """活动下一次需要处理的时间，已经处理过的时间点顺延一个检查间隔"""
+        now = datetime.now()
+        last_run = self._last_run.get(activity.id)
+        retry_at = last_run + timedelta(seconds=self.check_interval) if last_run else None
+        if activity.activity_status == ActivityStatus.PENDING.value:
+            events = [activity.start_time]
+        elif activity.activity_status == ActivityStatus.ACTIVE.value:
+            events = [activity.end_time]
+            if activity.end_time - activity.start_time >= self.CHECK_WINDOW and now < activity.end_time:
+                # 检查窗口内两次检查至少间隔 check_interval
+                check_at = activity.end_time - self.CHECK_WINDOW
+                events.append(max(check_at, retry_at) if retry_at else check_at)
+        else:
+            return None
+        if last_run:
+            events = [due if due > last_run else retry_at for due in events]
+        return min(events)
+    
+    def _schedule(self, activity: Activity) -> None:
+        due = self._next_due(activity)
+        if due is None:
+            return
+        generation = self._generations.get(activity.id, 0) + 1
+        self._generations[activity.id] = generation
+        heapq.heappush(self._deadlines, (due, activity.id, generation))
+    
+    def _dispatch(self, activity_id: int) -> None:
+        """后台处理到期活动，同一活动同时只处理一次"""
+        activity = self._activities.get(activity_id)
+        if not activity or activity_id in self._inflight:
+            return
+        if not self.coordinator.owns(activity_id):
+            # 不归本节点负责，顺延一个检查间隔再看（节点变化后可能接手）
+            self._last_run[activity_id] = datetime.now()
+            self._schedule(activity)
+            return
+        self._inflight[activity_id] = asyncio.create_task(self._run_activity(activity))
+    
+    async def _run_activity(self, activity: Activity) -> None:
+        self._last_run[activity.id] = datetime.now()
+        changed = False
+        try:
+            changed = await self._process_activity(activity, self._semaphore)
+        finally:
+            self._inflight.pop(activity.id, None)
+            self._schedule(self._activities.get(activity.id, activity))
+            if changed:
+                # 开始/结束后活动状态已变，马上检测变化并重新排期；只做检查不改状态，不用重新同步
+                self._next_sync = 0.0
+            self._wakeup.set()
 
-    async def _process_activity(self, activity, semaphore: asyncio.Semaphore) -> None:
-        """处理单个活动"""
+    async def _process_activity(self, activity, semaphore: asyncio.Semaphore) -> bool:
+        """处理单个活动，返回是否执行了开始/结束（活动状态可能已变）"""
         async with semaphore:
             try:
                 if activity.should_start():
-                    await self._handle_activity_start(activity)
+                    await self._run_claimed(f"start:{activity.id}", self._handle_activity_start, activity)
+                    return True
                 elif activity.should_end():
-                    await self._handle_activity_end(activity)
+                    await self._run_claimed(f"end:{activity.id}", self._handle_activity_end, activity)
+                    return True
                 elif activity.should_check():
                     await self._handle_activity_check(activity)
             except Exception as e:
                 app_logger.error(f"处理活动 {activity.id} 时出错: {e}", exc_info=True)
+                return True
+        return False
+
+    async def _run_claimed(self, key: str, handler: Callable[..., Awaitable], activity) -> None:
+        """抢占后执行，执行期间协调器持续续约；失败时释放抢占以便重试"""
+        if not await self.coordinator.claim(key):
+            return
+        succeeded = False
+        try:
+            await handler(activity)
+            succeeded = True
+        finally:
+            await self.coordinator.finish(key, succeeded)
 
     async def _handle_activity_start(self, activity) -> None:
         """处理活动开始"""
@@ -184,7 +387,7 @@ class ActivityScheduler(ISchedulerService):
         # 发送开始通知
         await self._send_activity_notification(
             activity, 
-            self.notification_service.send_activity_start_notification
+            self.notification_service.render_start_notification
         )
         
         # 标记为已检查
@@ -202,13 +405,12 @@ class ActivityScheduler(ISchedulerService):
         # 更新活动状态
         activity.status = ActivityStatus.ENDED.value
         await self.repository.set_activity_status(activity.id, ActivityStatus.ENDED.value)
+        verification_tracker.forget(activity.id)
         
         # 发送结束通知
         await self._send_activity_notification(
             activity, 
-            lambda act, scope: self.notification_service.send_activity_end_notification(
-                act, scope, self.repository
-            )
+            self.notification_service.render_end_notification
         )
         
         app_logger.info(f"活动已结束 {activity} 范围scope: {activity.scope}")
@@ -221,115 +423,161 @@ class ActivityScheduler(ISchedulerService):
         except Exception as e:
             app_logger.error(f"活动检查失败 {activity.id}: {e}", exc_info=True)
 
-    async def _send_activity_notification(self, activity, notification_func) -> None:
-        """发送活动通知（统一处理单个群组和标签群组）"""
+    async def _send_activity_notification(self, activity, render_func) -> None:
+        """发送活动通知（统一处理单个群组和标签群组）：每个活动只渲染一次，再分发到各群"""
         try:
             if activity.scope.startswith("-100"):
                 # 单个群组
-                await notification_func(activity, activity.scope)
+                chat_ids = [activity.scope]
             else:
                 # 标签群组
                 groups = await self.repository.get_groups_by_tag(
                     activity.scope, 
                     activity.sys_user_id
                 )
-                
-                # 并发发送通知，但限制并发数
-                semaphore = asyncio.Semaphore(5)  # 最多同时发送5个通知
-                tasks = [
-                    self._send_single_notification(notification_func, activity, group, semaphore)
-                    for group in groups
-                ]
-                await asyncio.gather(*tasks, return_exceptions=True)
-                
+                chat_ids = [group["group_id"] for group in groups]
+            if not chat_ids:
+                return
+            
+            rendered = await render_func(activity)
+            results = await self.fanout.dispatch(
+                chat_ids,
+                lambda chat_id: self.notification_service.send_rendered(activity, chat_id, rendered)
+            )
+            failed = {chat_id: error for chat_id, error in results.items() if error != "ok"}
+            app_logger.info(f"活动通知发送完成 {activity.id}: 共 {len(results)} 个群, 失败 {len(failed)} 个, 失败详情: {failed}")
         except Exception as e:
             app_logger.error(f"发送活动通知失败 {activity.id}: {e}", exc_info=True)
 
-    async def _send_single_notification(self, notification_func, activity, group, semaphore):
-        """发送单个通知"""
-        async with semaphore:
-            try:
-                await notification_func(activity, group["group_id"])
-            except Exception as e:
-                app_logger.error(f"发送通知到群组 {group['group_id']} 失败: {e}")
-
     async def _validate_and_choose_winners(self, activity) -> None:
-        """验证用户条件并选择获奖者"""
+        """批量计算合格用户（每个条件一个位图，按位与），写回有变化的状态后直接用合格集合抽奖；
+        验证或写入中奖用户失败时异常抛给调用方，活动不标记结束，下次调度重新开奖"""
+        bot = await self._get_bot(activity.sys_user_id)
+        session = await ValidationSession.open(self.repository, activity.id, bot)
+        if not session:
+            app_logger.info(f"活动 {activity.id} 不存在，跳过开奖")
+            return
         try:
-            bot = await self._get_bot(activity.sys_user_id)
-            await self._validate_users_conditions(activity, bot)
+            participants = ParticipantColumns(activity.id, keep_text=False)
+            async for page in self.repository.iter_activity_users(activity.id):
+                participants.extend(page)
+            result = await self.eligibility.evaluate(session, participants, self.final_freshness)
+            eligible_indexes = result.eligible_indexes()
             
-            # 用activity_id重新获取下活动
-            activity = await self.repository.get_all_activities(activity_id=activity.id)
-            activity = activity[0]
+            # 合格状态有变化的用户批量写回
+            eligible = set(eligible_indexes)
+            statuses = {}
+            for index, (user_id, condition_status) in enumerate(zip(participants.user_ids, participants.condition_statuses)):
+                new_status = 1 if index in eligible else 0
+                if new_status != condition_status:
+                    statuses[user_id] = new_status
+            if statuses:
+                await self.repository.bulk_update_condition_status(activity.id, statuses)
             
             # 选择获奖者
-            finish_condition_users = [
-                user for user in activity.activity_users 
-                if user.condition_status
-            ]
-            
-            if finish_condition_users and activity.prices:
+            if session.activity.prices:
                 await self.prizes_choice.random_choice_prizer(
                     self.repository, 
-                    activity.prices, 
-                    finish_condition_users
+                    session.activity.prices, 
+                    participants.take(eligible_indexes),
+                    weighers=await self._prize_weighers(session)
                 )
             else:
-                app_logger.info(f"活动 {activity.id} 无符合条件的用户或无奖品")
-                
-        except Exception as e:
-            app_logger.error(f"验证用户条件和选择获奖者失败 {activity.id}: {e}", exc_info=True)
+                app_logger.info(f"活动 {activity.id} 无奖品")
+        finally:
+            session.close()
+
+    async def _prize_weighers(self, session: ValidationSession) -> Dict[str, Callable]:
+        """奖品配置的中奖权重：weight_by -> 计算用户权重的函数，发言次数用开奖上下文里已加载的统计"""
+        weighers = {}
+        activity = session.activity
+        weight_by = {prize.weight_by for prize in activity.prices}
+        if "speech_count" in weight_by and speech_count_engine.speech_groups(activity):
+            counts = await session.load_speech_counts()
+            weighers["speech_count"] = lambda user: sum(counts.get(int(user.user_id), {}).values())
+        return weighers
 
     async def _validate_users_conditions(self, activity, bot) -> None:
-        """验证所有用户条件"""
-        if not activity.activity_users:
-            return
+        """检查窗口内分页验证用户条件，中断后下次从上次验证到的用户继续；
+        只验证从未验证过、结果超过新鲜度窗口或验证后有相关事件的用户"""
+        freshness = self.check_freshness
+        cursor_key = activity.id
+        after_id = self._sweep_cursors.get(cursor_key, 0)
+        if after_id:
+            app_logger.info(f"活动 {activity.id} 从上次中断处继续验证 after_id: {after_id}")
             
+        # 整轮扫描共用一个验证上下文：活动只加载一次，发言次数整个活动聚合一次
+        writer = ConditionStatusWriter(self.repository)
+        session = await ValidationSession.open(self.repository, activity.id, bot, writer)
+        if not session:
+            app_logger.info(f"活动 {activity.id} 不存在，跳过验证")
+            return
+        
         # 并发验证用户条件，但限制并发数
         semaphore = asyncio.Semaphore(20)  # 最多同时验证20个用户
-        tasks = [
-            self._validate_single_user(user, activity, bot, semaphore)
-            for user in activity.activity_users
-        ]
-        
-        results = await asyncio.gather(*tasks, return_exceptions=True)
+        failed_count = 0
+        written_count = 0
+        fresh_count = 0
+        try:
+            async for page in self.repository.iter_activity_users(activity.id, after_id=after_id):
+                now = time.monotonic()
+                users = [user for user in page if verification_tracker.needs_check(activity.id, user.user_id, freshness, now)]
+                fresh_count += len(page) - len(users)
+                if users:
+                    writer.track(users)
+                    await self.validator.prefetch(session.activity, [user.user_id for user in users])
+                    tasks = [
+                        self._validate_single_user(user, session, semaphore)
+                        for user in users
+                    ]
+                    results = await asyncio.gather(*tasks, return_exceptions=True)
+                    failed_count += sum(1 for result in results if isinstance(result, Exception) or "error" in result)
+                    # 每页验证完批量写入状态，写入成功后才推进游标、记录验证结果
+                    written_count += await writer.flush()
+                    writer.known.clear()
+                    for user, result in zip(users, results):
+                        if not isinstance(result, Exception) and "error" not in result:
+                            verification_tracker.record(activity.id, user.user_id, result["all_verified"], result["started_at"])
+                self._sweep_cursors[cursor_key] = page.ids[-1]
+        finally:
+            session.close()
         
-        # 记录验证失败的用户
-        # failed_count = sum(1 for result in results if isinstance(result, Exception))
-        # if failed_count > 0:
-        #     app_logger.warning(f"活动 {activity.id} 有 {failed_count} 个用户验证失败")
+        # 整轮完成，下次从头开始
+        self._sweep_cursors.pop(cursor_key, None)
+        app_logger.info(f"活动 {activity.id} 验证完成 结果仍有效跳过: {fresh_count} 个, 写入状态: {written_count} 个, 未变化跳过: {writer.skipped} 个")
+        if failed_count > 0:
+            app_logger.warning(f"活动 {activity.id} 有 {failed_count} 个用户验证失败")
 
-    async def _validate_single_user(self, user, activity, bot, semaphore):
+    async def _validate_single_user(self, user, session: ValidationSession, semaphore):
         """验证单个用户条件"""
         async with semaphore:
             try:
-                return await self.validator.validate_user_conditions(
+                return await self.validator.validate_in_session(
                     self.repository, 
+                    session, 
                     user.user_id, 
-                    activity.id, 
-                    bot, 
-                    activity.sys_user_id
+                    short_circuit=True
                 )
             except Exception as e:
                 app_logger.error(f"验证用户 {user.user_id} 条件失败: {e}")
                 raise
 
     async def _get_bot(self, sys_user_id: int) -> Bot:
-        """获取机器人实例（可以添加缓存）"""
+        """获取机器人实例（客户端从连接池复用）"""
         try:
             lottery_bot = await LotteryBot.get_lottery_bot(sys_user_id)
-            return Bot(lottery_bot["token"])
+            return await bot_pool.get(lottery_bot["token"])
         except Exception as e:
             app_logger.error(f"获取机器人失败 sys_user_id: {sys_user_id}, error: {e}")
             raise
 
             
-async def lottery_activity_scheduler():
-    repository = InMemoryRepository()
-    notification = TelegramNotificationService()
+async def lottery_activity_scheduler(coordinator: ISchedulerCoordinator = None):
+    """启动活动调度；多副本部署时传入 LeaderCoordinator 或 ShardedCoordinator"""
+    repository = CachedRepository(InMemoryRepository())
+    notification = TelegramNotificationService(repository)
     prizes_choice = ActivityPrizesChoice()
     validator = ConditionValidatorFactory()
     LotteryBot()
-    activity_scheduler = ActivityScheduler(repository, notification, prizes_choice, validator)
+    activity_scheduler = ActivityScheduler(repository, notification, prizes_choice, validator, coordinator=coordinator)
     return await activity_scheduler.task_scheduler()
\ No newline at end of file
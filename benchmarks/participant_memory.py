@@ -0,0 +1,63 @@
+"""参与用户内存占用对比：List[ActivityUser] 与 ParticipantColumns
+
+用法（在 app 的上级目录执行）：
+    python -m app.lottery_activity_handler.benchmarks.participant_memory 100000
+"""
+import sys
+import tracemalloc
+
+from app.lottery_activity_handler.data_class import ActivityUser, ParticipantColumns
+
+
+def make_rows(count: int) -> list:
+    return [
+        {
+            "id": index + 1,
+            "user_name": f"user_{index}",
+            "user_id": 5000000000 + index,
+            "full_name": f"Full Name {index}",
+            "condition_status": index % 2,
+            "winning_status": 1,
+            "winning_content": "",
+            "activity_id": 1,
+            "prize_level": 0
+        }
+        for index in range(count)
+    ]
+
+
+def measure(build) -> tuple:
+    tracemalloc.start()
+    value = build()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return value, current, peak
+
+
+def main(count: int) -> None:
+    rows = make_rows(count)
+    layouts = {
+        "List[ActivityUser]": lambda: [ActivityUser(**row) for row in rows],
+        "ParticipantColumns": lambda: ParticipantColumns.from_rows(rows),
+        "ParticipantColumns(keep_text=False)": lambda: _without_text(rows),
+    }
+    print(f"参与用户: {count}")
+    for name, build in layouts.items():
+        value, current, peak = measure(build)
+        print(f"{name:<38} 占用: {current / 1024 / 1024:8.2f} MB  峰值: {peak / 1024 / 1024:8.2f} MB  每人: {current / count:7.1f} B")
+        del value
+
+
+def _without_text(rows: list) -> ParticipantColumns:
+    columns = ParticipantColumns(keep_text=False)
+    for row in rows:
+        columns.ids.append(row["id"])
+        columns.user_ids.append(row["user_id"])
+        columns.condition_statuses.append(row["condition_status"])
+        columns.winning_statuses.append(row["winning_status"])
+        columns.prize_levels.append(row["prize_level"])
+    return columns
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,58 @@
+import asyncio
+import time
+from typing import Dict, Tuple
+
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+from app.lottery_activity_handler.rate_limiter import RateLimitedBot
+from app.lottery_activity_handler.logger_handler import app_logger
+
+
+class BotPool:
+    """按 token 复用 telegram.Bot 客户端，每个 token 一个长连接池，空闲超时后关闭；返回的客户端调用都经过限流器。
+    空闲按客户端最近一次实际调用计算，不按 get() 的时间，长时间持有客户端（如开奖会话）持续调用时不会被回收"""
+
+    def __init__(self, idle_timeout: float = 600.0, connection_pool_size: int = 32):
+        self.idle_timeout = idle_timeout
+        self.connection_pool_size = connection_pool_size
+        self._clients: Dict[str, Tuple[RateLimitedBot, HTTPXRequest, HTTPXRequest]] = {}
+        self._evicted_at = time.monotonic()
+
+    async def get(self, token: str) -> RateLimitedBot:
+        client = self._clients.get(token)
+        if client is None:
+            request = HTTPXRequest(connection_pool_size=self.connection_pool_size)
+            updates_request = HTTPXRequest(connection_pool_size=1)
+            bot = RateLimitedBot(Bot(token, request=request, get_updates_request=updates_request))
+            client = (bot, request, updates_request)
+            self._clients[token] = client
+            app_logger.info(f"机器人连接池新建客户端: 共 {len(self._clients)} 个")
+        client[0].last_used = time.monotonic()
+        if time.monotonic() - self._evicted_at >= self.idle_timeout / 2:
+            await self.evict_idle()
+        return client[0]
+
+    async def _shutdown(self, token: str) -> None:
+        client = self._clients.pop(token, None)
+        if client:
+            _, request, updates_request = client
+            await asyncio.gather(request.shutdown(), updates_request.shutdown(), return_exceptions=True)
+
+    async def evict_idle(self) -> None:
+        """关闭空闲超时且没有进行中调用的客户端"""
+        self._evicted_at = time.monotonic()
+        idle_tokens = [token for token, (bot, _, _) in self._clients.items() if bot.idle_for(self._evicted_at) >= self.idle_timeout]
+        for token in idle_tokens:
+            await self._shutdown(token)
+        if idle_tokens:
+            app_logger.info(f"机器人连接池回收空闲客户端: {len(idle_tokens)} 个, 剩余: {len(self._clients)} 个")
+
+    async def close(self) -> None:
+        """关闭所有客户端"""
+        for token in list(self._clients):
+            await self._shutdown(token)
+
+
+# 进程内共享的机器人客户端池
+bot_pool = BotPool()
@@ -0,0 +1,307 @@
+import asyncio
+import hashlib
+import os
+import socket
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+
+from mysql.aio import aio_mysql
+from app.lottery_activity_handler.logger_handler import app_logger
+
+
+def default_node_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class ILeaseBackend(ABC):
+    """租约和节点心跳存储接口"""
+
+    @abstractmethod
+    async def acquire_lease(self, name: str, node_id: str, ttl: float) -> bool:
+        """获取或续期租约，成功返回 True"""
+        pass
+
+    @abstractmethod
+    async def release_lease(self, name: str, node_id: str) -> None:
+        pass
+
+    @abstractmethod
+    async def heartbeat(self, node_id: str) -> None:
+        pass
+
+    @abstractmethod
+    async def live_nodes(self, ttl: float) -> List[str]:
+        """最近 ttl 秒内有心跳的节点"""
+        pass
+
+    @abstractmethod
+    async def leave(self, node_id: str) -> None:
+        pass
+
+
+class MySQLLeaseBackend(ILeaseBackend):
+    """MySQL 租约存储，时间统一用数据库时间"""
+
+    def __init__(self):
+        self._table_ready = False
+
+    async def _ensure_tables(self) -> None:
+        if self._table_ready:
+            return
+        await aio_mysql.execute_sql("""CREATE TABLE IF NOT EXISTS scheduler_lease (
+            name VARCHAR(128) NOT NULL PRIMARY KEY,
+            holder VARCHAR(128) NOT NULL,
+            expires_at DATETIME(3) NOT NULL
+        )""")
+        await aio_mysql.execute_sql("""CREATE TABLE IF NOT EXISTS scheduler_nodes (
+            node_id VARCHAR(128) NOT NULL PRIMARY KEY,
+            heartbeat_at DATETIME(3) NOT NULL
+        )""")
+        self._table_ready = True
+
+    async def acquire_lease(self, name: str, node_id: str, ttl: float) -> bool:
+        await self._ensure_tables()
+        # 持有者是自己或租约已过期时才改写；ON DUPLICATE KEY UPDATE 按顺序赋值，第二个 IF 看到的是新的 holder
+        await aio_mysql.execute_sql(f"""INSERT INTO scheduler_lease (name, holder, expires_at)
+            VALUES ('{name}', '{node_id}', NOW(3) + INTERVAL {int(ttl * 1000000)} MICROSECOND)
+            ON DUPLICATE KEY UPDATE
+            holder = IF(holder = VALUES(holder) OR expires_at < NOW(3), VALUES(holder), holder),
+            expires_at = IF(holder = VALUES(holder), VALUES(expires_at), expires_at)""")
+        res = await aio_mysql.execute_sql(f"SELECT holder FROM scheduler_lease WHERE name = '{name}'")
+        return bool(res.data) and res.data[0]["holder"] == node_id
+
+    async def release_lease(self, name: str, node_id: str) -> None:
+        await self._ensure_tables()
+        await aio_mysql.execute_sql(f"DELETE FROM scheduler_lease WHERE name = '{name}' AND holder = '{node_id}'")
+
+    async def heartbeat(self, node_id: str) -> None:
+        await self._ensure_tables()
+        await aio_mysql.execute_sql(f"INSERT INTO scheduler_nodes (node_id, heartbeat_at) VALUES ('{node_id}', NOW(3)) \
+            ON DUPLICATE KEY UPDATE heartbeat_at = NOW(3)")
+
+    async def live_nodes(self, ttl: float) -> List[str]:
+        await self._ensure_tables()
+        res = await aio_mysql.execute_sql(f"SELECT node_id FROM scheduler_nodes \
+            WHERE heartbeat_at > NOW(3) - INTERVAL {int(ttl * 1000000)} MICROSECOND ORDER BY node_id")
+        return [row["node_id"] for row in res.data or []]
+
+    async def leave(self, node_id: str) -> None:
+        await self._ensure_tables()
+        await aio_mysql.execute_sql(f"DELETE FROM scheduler_nodes WHERE node_id = '{node_id}'")
+
+
+class SQLiteLeaseBackend(ILeaseBackend):
+    """SQLite 租约存储，用于本地运行和测试，默认内存库（同一个实例在进程内共享）"""
+
+    def __init__(self, path: str = ":memory:"):
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS scheduler_lease (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS scheduler_nodes (node_id TEXT PRIMARY KEY, heartbeat_at REAL NOT NULL)")
+
+    async def acquire_lease(self, name: str, node_id: str, ttl: float) -> bool:
+        now = time.time()
+        self.conn.execute(
+            "INSERT INTO scheduler_lease (name, holder, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+            "WHERE scheduler_lease.holder = excluded.holder OR scheduler_lease.expires_at < ?",
+            (name, node_id, now + ttl, now)
+        )
+        row = self.conn.execute("SELECT holder FROM scheduler_lease WHERE name = ?", (name,)).fetchone()
+        return bool(row) and row[0] == node_id
+
+    async def release_lease(self, name: str, node_id: str) -> None:
+        self.conn.execute("DELETE FROM scheduler_lease WHERE name = ? AND holder = ?", (name, node_id))
+
+    async def heartbeat(self, node_id: str) -> None:
+        self.conn.execute(
+            "INSERT INTO scheduler_nodes (node_id, heartbeat_at) VALUES (?, ?) "
+            "ON CONFLICT(node_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at",
+            (node_id, time.time())
+        )
+
+    async def live_nodes(self, ttl: float) -> List[str]:
+        rows = self.conn.execute("SELECT node_id FROM scheduler_nodes WHERE heartbeat_at > ? ORDER BY node_id", (time.time() - ttl,)).fetchall()
+        return [row[0] for row in rows]
+
+    async def leave(self, node_id: str) -> None:
+        self.conn.execute("DELETE FROM scheduler_nodes WHERE node_id = ?", (node_id,))
+
+
+class ISchedulerCoordinator(ABC):
+    """多节点调度协调接口"""
+
+    @abstractmethod
+    async def start(self) -> None:
+        pass
+
+    @abstractmethod
+    async def stop(self) -> None:
+        pass
+
+    @abstractmethod
+    def owns(self, activity_id: int) -> bool:
+        """本节点是否负责这个活动"""
+        pass
+
+    @abstractmethod
+    async def claim(self, key: str) -> bool:
+        """开始/开奖这类只能执行一次的动作，执行前先抢占；抢占后到 finish 之前一直持有"""
+        pass
+
+    @abstractmethod
+    async def finish(self, key: str, succeeded: bool) -> None:
+        """动作结束：成功时保留抢占直到过期，失败时释放，其他节点或下次调度可以重试"""
+        pass
+
+
+class StandaloneCoordinator(ISchedulerCoordinator):
+    """单节点部署，负责所有活动"""
+
+    async def start(self) -> None:
+        pass
+
+    async def stop(self) -> None:
+        pass
+
+    def owns(self, activity_id: int) -> bool:
+        return True
+
+    async def claim(self, key: str) -> bool:
+        return True
+
+    async def finish(self, key: str, succeeded: bool) -> None:
+        pass
+
+
+class LeaseCoordinator(ISchedulerCoordinator):
+    """基于租约的协调器基类，后台定时续约/心跳；抢占的动作在执行期间同样后台续约，开奖耗时超过 claim_ttl 也不会被其他节点重复执行"""
+
+    def __init__(self, backend: ILeaseBackend, node_id: str = None, ttl: float = 30.0, claim_ttl: float = 600.0):
+        self.backend = backend
+        self.node_id = node_id or default_node_id()
+        self.ttl = ttl
+        self.claim_ttl = claim_ttl
+        self._task: Optional[asyncio.Task] = None
+        self._claims: Dict[str, asyncio.Task] = {}  # 执行中的动作 -> 续约任务
+
+    async def start(self) -> None:
+        await self.refresh()
+        self._task = asyncio.create_task(self._renew_loop())
+
+    async def stop(self) -> None:
+        for task in [self._task, *self._claims.values()]:
+            if task:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._claims.clear()
+        await self._leave()
+
+    async def _renew_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self.refresh()
+            except Exception as e:
+                app_logger.error(f"调度协调续约失败 node_id: {self.node_id}, error: {e}", exc_info=True)
+
+    async def claim(self, key: str) -> bool:
+        claimed = await self.backend.acquire_lease(f"claim:{key}", self.node_id, self.claim_ttl)
+        if not claimed:
+            app_logger.info(f"调度动作已被其他节点执行 key: {key}, node_id: {self.node_id}")
+        elif key not in self._claims:
+            self._claims[key] = asyncio.create_task(self._renew_claim(key))
+        return claimed
+
+    async def _renew_claim(self, key: str) -> None:
+        while True:
+            await asyncio.sleep(self.claim_ttl / 3)
+            try:
+                if not await self.backend.acquire_lease(f"claim:{key}", self.node_id, self.claim_ttl):
+                    app_logger.error(f"调度动作租约已被其他节点抢占 key: {key}, node_id: {self.node_id}")
+                    return
+            except Exception as e:
+                app_logger.error(f"调度动作续约失败 key: {key}, node_id: {self.node_id}, error: {e}", exc_info=True)
+
+    async def finish(self, key: str, succeeded: bool) -> None:
+        task = self._claims.pop(key, None)
+        if task:
+            task.cancel()
+        if not succeeded:
+            try:
+                await self.backend.release_lease(f"claim:{key}", self.node_id)
+            except Exception as e:
+                # 释放失败时等租约过期后再重试
+                app_logger.error(f"释放调度动作租约失败 key: {key}, node_id: {self.node_id}, error: {e}", exc_info=True)
+
+    @abstractmethod
+    async def refresh(self) -> None:
+        pass
+
+    @abstractmethod
+    async def _leave(self) -> None:
+        pass
+
+
+class LeaderCoordinator(LeaseCoordinator):
+    """主节点选举：持有租约的节点负责所有活动，其他节点待命"""
+
+    LEASE_NAME = "lottery_activity_scheduler"
+
+    def __init__(self, backend: ILeaseBackend, node_id: str = None, ttl: float = 30.0, claim_ttl: float = 600.0):
+        super().__init__(backend, node_id, ttl, claim_ttl)
+        self.is_leader = False
+
+    async def refresh(self) -> None:
+        try:
+            is_leader = await self.backend.acquire_lease(self.LEASE_NAME, self.node_id, self.ttl)
+        except Exception:
+            # 续约失败时无法确认仍持有租约，先让出
+            self.is_leader = False
+            raise
+        if is_leader != self.is_leader:
+            app_logger.info(f"调度主节点变化 node_id: {self.node_id}, is_leader: {is_leader}")
+        self.is_leader = is_leader
+
+    def owns(self, activity_id: int) -> bool:
+        return self.is_leader
+
+    async def _leave(self) -> None:
+        if self.is_leader:
+            await self.backend.release_lease(self.LEASE_NAME, self.node_id)
+            self.is_leader = False
+
+
+class ShardedCoordinator(LeaseCoordinator):
+    """按活动id分片：节点定时心跳，活动用最高随机权重哈希（rendezvous）分配到存活节点"""
+
+    def __init__(self, backend: ILeaseBackend, node_id: str = None, ttl: float = 30.0, claim_ttl: float = 600.0):
+        super().__init__(backend, node_id, ttl, claim_ttl)
+        self.nodes: List[str] = [self.node_id]
+
+    async def refresh(self) -> None:
+        await self.backend.heartbeat(self.node_id)
+        nodes = await self.backend.live_nodes(self.ttl)
+        if self.node_id not in nodes:
+            nodes.append(self.node_id)
+        nodes.sort()
+        if nodes != self.nodes:
+            app_logger.info(f"调度节点变化 node_id: {self.node_id}, nodes: {nodes}")
+        self.nodes = nodes
+
+    @staticmethod
+    def _weight(node_id: str, activity_id: int) -> int:
+        return int.from_bytes(hashlib.md5(f"{node_id}:{activity_id}".encode()).digest()[:8], "big")
+
+    def owner(self, activity_id: int) -> str:
+        return max(self.nodes, key=lambda node_id: self._weight(node_id, activity_id))
+
+    def owns(self, activity_id: int) -> bool:
+        return self.owner(activity_id) == self.node_id
+
+    async def _leave(self) -> None:
+        await self.backend.leave(self.node_id)
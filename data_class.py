@@ -1,12 +1,15 @@
 
+from array import array
 from dataclasses import dataclass, field
 from datetime import datetime
 from enum import Enum
-from typing import Dict, List
+from typing import Dict, Iterator, List
 from telegram import Bot
 
 from mysql.aio import aio_mysql
 from helper import *
+from app.lottery_activity_handler.bot_pool import bot_pool
+from app.lottery_activity_handler.cache import TTLCache
 from app.lottery_activity_handler.logger_handler import app_logger
 
 class ActivityStatus(Enum):
@@ -59,6 +62,7 @@ class Price:
     prize_name: str
     prize_content: str
     prize_count: int
+    weight_by: str = ""  # 中奖权重："" 等概率，"speech_count" 按活动发言条件群里的发言次数加权
 
 @dataclass
 class ActivityReply:
@@ -83,6 +87,116 @@ class ActivityUser:
     activity_id: int
     prize_level: int
 
+
+class ParticipantColumns:
+    """参与用户列式存储：数值字段存在平行的 array 列里，按下标或迭代时才临时生成 ActivityUser；
+    keep_text=False 时不保存用户名/中奖内容（抽奖候选人只需要 id 和 user_id）"""
+    
+    __slots__ = ("activity_id", "keep_text", "ids", "user_ids", "condition_statuses", "winning_statuses", "prize_levels",
+                 "user_names", "full_names", "winning_contents")
+    
+    def __init__(self, activity_id: int = 0, keep_text: bool = True):
+        self.activity_id = activity_id
+        self.keep_text = keep_text
+        self.ids = array("q")
+        self.user_ids = array("q")
+        self.condition_statuses = array("b")
+        self.winning_statuses = array("b")
+        self.prize_levels = array("h")
+        self.user_names: List[str] = []
+        self.full_names: List[str] = []
+        self.winning_contents: List[str] = []
+    
+    @classmethod
+    def from_rows(cls, rows: List[dict], activity_id: int = 0) -> "ParticipantColumns":
+        """数据库行直接写入各列，不生成中间对象"""
+        columns = cls(int(rows[0]["activity_id"]) if rows else activity_id)
+        for row in rows:
+            columns.ids.append(int(row["id"]))
+            columns.user_ids.append(int(row["user_id"]))
+            columns.condition_statuses.append(int(row["condition_status"] or 0))
+            columns.winning_statuses.append(int(row["winning_status"] or 0))
+            columns.prize_levels.append(int(row["prize_level"] or 0))
+            columns.user_names.append(row["user_name"] or "")
+            columns.full_names.append(row["full_name"] or "")
+            columns.winning_contents.append(row["winning_content"] or "")
+        return columns
+    
+    def append(self, user: ActivityUser) -> None:
+        self.activity_id = self.activity_id or int(user.activity_id)
+        self.ids.append(int(user.id))
+        self.user_ids.append(int(user.user_id))
+        self.condition_statuses.append(int(user.condition_status or 0))
+        self.winning_statuses.append(int(user.winning_status or 0))
+        self.prize_levels.append(int(user.prize_level or 0))
+        if self.keep_text:
+            self.user_names.append(user.user_name or "")
+            self.full_names.append(user.full_name or "")
+            self.winning_contents.append(user.winning_content or "")
+    
+    def extend(self, users) -> None:
+        if isinstance(users, ParticipantColumns):
+            # 列对列拼接，不生成中间对象
+            self.activity_id = self.activity_id or users.activity_id
+            self.ids.extend(users.ids)
+            self.user_ids.extend(users.user_ids)
+            self.condition_statuses.extend(users.condition_statuses)
+            self.winning_statuses.extend(users.winning_statuses)
+            self.prize_levels.extend(users.prize_levels)
+            if self.keep_text:
+                if users.keep_text:
+                    self.user_names.extend(users.user_names)
+                    self.full_names.extend(users.full_names)
+                    self.winning_contents.extend(users.winning_contents)
+                else:
+                    blank = [""] * len(users)
+                    self.user_names.extend(blank)
+                    self.full_names.extend(blank)
+                    self.winning_contents.extend(blank)
+            return
+        for user in users:
+            self.append(user)
+    
+    def take(self, indexes: List[int]) -> "ParticipantColumns":
+        """按下标取出子集（保持下标顺序）"""
+        subset = ParticipantColumns(self.activity_id, self.keep_text)
+        subset.ids = array("q", (self.ids[i] for i in indexes))
+        subset.user_ids = array("q", (self.user_ids[i] for i in indexes))
+        subset.condition_statuses = array("b", (self.condition_statuses[i] for i in indexes))
+        subset.winning_statuses = array("b", (self.winning_statuses[i] for i in indexes))
+        subset.prize_levels = array("h", (self.prize_levels[i] for i in indexes))
+        if self.keep_text:
+            subset.user_names = [self.user_names[i] for i in indexes]
+            subset.full_names = [self.full_names[i] for i in indexes]
+            subset.winning_contents = [self.winning_contents[i] for i in indexes]
+        return subset
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def __getitem__(self, index: int) -> ActivityUser:
+        if index < 0:
+            index += len(self.ids)
+        return ActivityUser(
+            id=self.ids[index],
+            user_name=self.user_names[index] if self.keep_text else "",
+            user_id=self.user_ids[index],
+            full_name=self.full_names[index] if self.keep_text else "",
+            condition_status=self.condition_statuses[index],
+            winning_status=self.winning_statuses[index],
+            winning_content=self.winning_contents[index] if self.keep_text else "",
+            activity_id=self.activity_id,
+            prize_level=self.prize_levels[index]
+        )
+    
+    def __iter__(self) -> Iterator[ActivityUser]:
+        for index in range(len(self.ids)):
+            yield self[index]
+    
+    def __repr__(self) -> str:
+        return f"ParticipantColumns(activity_id={self.activity_id}, size={len(self.ids)})"
+
+
 @dataclass
 class Activity:
     """抽奖活动"""
@@ -94,7 +208,6 @@ class Activity:
     sys_user_id: int
     scope: str
     checked: int
-    activity_users: List[ActivityUser] = field(default_factory=list)
     conditions: List[Condition] = field(default_factory=list)
     activity_status: ActivityStatus = ActivityStatus.PENDING
     activities_reply: Dict[int, ActivityReply] = field(default_factory=dict)
@@ -137,6 +250,12 @@ class Activity:
 
 class LotteryBot():
     """抽奖机器人"""
+    # 机器人解析缓存：sys_user_id -> 抽奖机器人，(目标群/频道, 类型, sys_user_id) -> token；查不到的结果用较短的过期时间缓存
+    _lottery_bots = TTLCache(maxsize=1024, ttl=300)
+    _first_bots = TTLCache(maxsize=8192, ttl=300)
+    NEGATIVE_TTL = 30
+    _MISSING = object()
+    
     def __init__(self):
         pass
 
@@ -149,20 +268,50 @@ class LotteryBot():
             return True
         return False
     
+    @staticmethod
     async def get_lottery_bot(sys_user_id):
+        key = int(sys_user_id)
+        lottery_bot = LotteryBot._lottery_bots.get(key, LotteryBot._MISSING)
+        if lottery_bot is not LotteryBot._MISSING:
+            return lottery_bot
         res = await aio_mysql.execute_sql(f"SELECT * FROM bot_tokens WHERE created_by={sys_user_id} AND is_activity=1")
         app_logger.info(f"获取抽奖活动机器人: sys_user_id: {sys_user_id}, res_msg: {res.msg}, res_data: {res.data}")
         if res.data:
+            LotteryBot._lottery_bots.set(key, res.data[0])
             return res.data[0]
+        if res.code == 200:
+            LotteryBot._lottery_bots.set(key, False, ttl=LotteryBot.NEGATIVE_TTL)
         return False
     
     @staticmethod
     async def get_first_bot(group_id, tag, sys_user_id) -> Bot:
-        bot = get_first_group_bot(group_id, sys_user_id) if tag == "join_group" else get_first_channel_bot(group_id, sys_user_id)
-        bot_token = bot[0]["token"]
-        bot = Bot(bot_token)
+        key = (str(group_id), tag, int(sys_user_id))
+        bot_token = LotteryBot._first_bots.get(key, LotteryBot._MISSING)
+        if bot_token is LotteryBot._MISSING:
+            bot = get_first_group_bot(group_id, sys_user_id) if tag == "join_group" else get_first_channel_bot(group_id, sys_user_id)
+            bot_token = bot[0]["token"] if bot else None
+            LotteryBot._first_bots.set(key, bot_token, ttl=None if bot_token else LotteryBot.NEGATIVE_TTL)
+        if not bot_token:
+            raise LookupError(f"群组/频道没有可用机器人: group_id: {group_id}, tag: {tag}, sys_user_id: {sys_user_id}")
+        bot = await bot_pool.get(bot_token)
         return bot
     
+    @staticmethod
+    def invalidate(sys_user_id=None) -> None:
+        """机器人配置变更后调用，不传 sys_user_id 时清空全部"""
+        if sys_user_id is None:
+            LotteryBot._lottery_bots.clear()
+            LotteryBot._first_bots.clear()
+            return
+        LotteryBot._lottery_bots.pop(int(sys_user_id))
+        for key in LotteryBot._first_bots.keys():
+            if key[2] == int(sys_user_id):
+                LotteryBot._first_bots.pop(key)
+    
+    @staticmethod
+    def cache_stats() -> Dict:
+        return {"lottery_bot": LotteryBot._lottery_bots.stats(), "first_bot": LotteryBot._first_bots.stats()}
+    
     @staticmethod
     async def get_start_command(bot_):
         bot, created_by, first_name, language = bot_
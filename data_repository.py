@@ -1,11 +1,14 @@
 import json
+import time
 from abc import ABC, abstractmethod
-from typing import Dict, List, Optional
+from typing import AsyncIterator, Dict, Iterable, List, Optional
 
 from mysql.aio import aio_mysql
 from helper import *
-from app.lottery_activity_handler.data_class import Activity, ActivityReply, Condition, ConditionType, Price, ActivityUser, ActivityStatus
+from app.lottery_activity_handler.data_class import Activity, ActivityReply, Condition, ConditionType, Price, ActivityUser, ActivityStatus, ParticipantColumns
 from sdk.dingding import DingTalk
+from app.lottery_activity_handler.cache import TTLCache
+from app.lottery_activity_handler.singleflight import SingleFlight
 from app.lottery_activity_handler.logger_handler import app_logger
 
 
@@ -20,6 +23,22 @@ class IDataRepository(ABC):
     async def get_all_activities(self, activity_id: int) -> List[Activity]:
         pass
     
+    @abstractmethod
+    async def get_activities_version(self) -> tuple:
+        pass
+    
+    def index_activities(self, activities: List[Activity]) -> None:
+        """全量加载到的进行中活动，有本地索引的仓储用来重建索引"""
+        pass
+    
+    @abstractmethod
+    async def get_all_reply(self, sys_user_id) -> Dict[int, ActivityReply]:
+        pass
+    
+    @abstractmethod
+    def iter_activity_users(self, activity_id: int, after_id: int = 0, page_size: int = 500) -> AsyncIterator[ParticipantColumns]:
+        pass
+    
     @abstractmethod
     async def set_activity_status(self, activity_id: int, activity_status: int):
         pass
@@ -32,10 +51,18 @@ class IDataRepository(ABC):
     async def update_activity_detail(self, activity_id: int, user_id: int, condition_status: int) -> None:
         pass
     
+    @abstractmethod
+    async def bulk_update_condition_status(self, activity_id: int, statuses: Dict[int, int]) -> None:
+        pass
+    
     @abstractmethod
     async def update_prize_user(self, prize_content: str, sql_id: int, prize_level: int) -> None:
         pass
     
+    @abstractmethod
+    async def record_winners(self, activity_id: int, winners: List[tuple]) -> None:
+        pass
+    
     @abstractmethod
     async def get_groups_by_tag(self, tag, sys_user_id) -> list:
         pass
@@ -65,141 +92,183 @@ class IDataRepository(ABC):
         pass
 
 
+class ConditionStatusWriter:
+    """缓冲用户条件验证结果，统一批量写库，状态没变化的记录不写"""
+    
+    def __init__(self, repository: IDataRepository):
+        self.repository = repository
+        self.known: Dict[tuple, int] = {}  # (activity_id, user_id) -> 库中当前状态
+        self.pending: Dict[int, Dict[int, int]] = {}  # activity_id -> {user_id: 新状态}
+        self.skipped = 0
+    
+    def track(self, users: Iterable[ActivityUser]) -> None:
+        """记录库中已有状态，用来跳过未变化的写入"""
+        for user in users:
+            self.known[(int(user.activity_id), int(user.user_id))] = user.condition_status
+    
+    def add(self, activity_id: int, user_id: int, condition_status: int) -> None:
+        key = (int(activity_id), int(user_id))
+        if self.known.get(key) == condition_status:
+            self.skipped += 1
+            return
+        self.pending.setdefault(key[0], {})[key[1]] = condition_status
+    
+    async def flush(self) -> int:
+        """写入缓冲的状态，返回写入条数"""
+        pending, self.pending = self.pending, {}
+        written = 0
+        for activity_id, statuses in pending.items():
+            await self.repository.bulk_update_condition_status(activity_id, statuses)
+            written += len(statuses)
+            for user_id, condition_status in statuses.items():
+                self.known[(activity_id, user_id)] = condition_status
+        return written
+
+
+class ReplyTemplateCache:
+    """按租户缓存回复模板，到检查间隔后比对指纹，只有模板改动才重新加载"""
+    
+    def __init__(self, check_interval: float = 30.0):
+        self.check_interval = check_interval
+        self.templates: Dict[int, Dict[int, ActivityReply]] = {}
+        self.fingerprints: Dict[int, tuple] = {}
+        self.checked_at: Dict[int, float] = {}
+    
+    def is_due(self, sys_user_id: int) -> bool:
+        return time.monotonic() - self.checked_at.get(sys_user_id, float("-inf")) >= self.check_interval
+    
+    def is_changed(self, sys_user_id: int, fingerprint: Optional[tuple]) -> bool:
+        return sys_user_id not in self.templates or self.fingerprints.get(sys_user_id) != fingerprint
+    
+    def store(self, sys_user_id: int, templates: Dict[int, ActivityReply], fingerprint: Optional[tuple]) -> None:
+        self.templates[sys_user_id] = templates
+        self.fingerprints[sys_user_id] = fingerprint
+    
+    def touch(self, sys_user_id: int) -> None:
+        self.checked_at[sys_user_id] = time.monotonic()
+    
+    def get(self, sys_user_id: int) -> Dict[int, ActivityReply]:
+        return self.templates.get(sys_user_id, {})
+    
+    def invalidate(self, sys_user_id: int = None) -> None:
+        if sys_user_id is None:
+            self.checked_at.clear()
+        else:
+            self.checked_at.pop(int(sys_user_id), None)
+
+
+# 进程内共享的回复模板缓存
+reply_cache = ReplyTemplateCache()
+
+
 class InMemoryRepository(IDataRepository):
     """内存数据仓储实现"""
     
     def __init__(self):
-        self.activities: Dict[str, Activity] = {}
+        self.activities: Dict[int, Activity] = {}  # 进行中活动索引 id -> Activity
         self.user_participations: Dict[str, Dict] = {}
     
     async def get_activity_by_id(self, activity_id: str) -> Optional[Activity]:
         app_logger.info(f"id获取活动: activity_id: {activity_id}")
-        activities = await self.get_all_activities()
-        for activity in activities:
-            if activity.id == int(activity_id):
-                return activity
-        return None
+        activity_id = int(activity_id)
+        activity = self.activities.get(activity_id)
+        if activity:
+            return activity
+        
+        # 索引未命中，只查询这一个活动
+        activities = await self._query_activities(self._live_conditions() + [f"u.id = {activity_id}"])
+        if not activities:
+            return None
+        self.activities[activity_id] = activities[0]
+        return activities[0]
     
-    async def get_all_reply(self, sys_user_id):
+    async def get_all_reply(self, sys_user_id) -> Dict[int, ActivityReply]:
         try:
-            activities_reply_data = await aio_mysql.execute_sql(f"SELECT * FROM activity_reply WHERE sys_user_id={sys_user_id}")
-            activities_reply = {}
-            if activities_reply_data.data:
-                for activity_reply in activities_reply_data.data:
-                    activities_reply[activity_reply["reply_type"]]=ActivityReply(
-                        id=activity_reply["id"],
-                        reply_type=activity_reply["reply_type"],
-                        content=activity_reply["content"],
-                        buttons=json.loads(activity_reply["buttons"]) if activity_reply["buttons"] else [],
-                        media=activity_reply["media"],
-                        sys_user_id=activity_reply["sys_user_id"],
-                    )
-            return activities_reply
+            replies = await self.get_replies([sys_user_id])
+            return replies.get(int(sys_user_id), {})
         except Exception as e:
             app_logger.error(f"获取用户恢复模板异常: {e}", exc_info= True)
     
+    async def get_replies(self, sys_user_ids: Iterable[int]) -> Dict[int, Dict[int, ActivityReply]]:
+        """批量获取多个租户的回复模板，模板未变化时直接走缓存；
+        查询失败时不更新缓存，已缓存的租户继续用旧模板，下次调用重试，没有缓存的租户抛出异常"""
+        sys_user_ids = {int(sys_user_id) for sys_user_id in sys_user_ids}
+        due_ids = [sys_user_id for sys_user_id in sys_user_ids if reply_cache.is_due(sys_user_id)]
+        if due_ids:
+            try:
+                fingerprints = await self._reply_fingerprints(due_ids)
+                changed_ids = [sys_user_id for sys_user_id in due_ids if reply_cache.is_changed(sys_user_id, fingerprints.get(sys_user_id))]
+                if changed_ids:
+                    templates = await self._load_replies(changed_ids)
+                    for sys_user_id in changed_ids:
+                        reply_cache.store(sys_user_id, templates.get(sys_user_id, {}), fingerprints.get(sys_user_id))
+                    app_logger.info(f"回复模板已刷新: sys_user_ids: {changed_ids}")
+            except Exception as e:
+                if any(sys_user_id not in reply_cache.templates for sys_user_id in due_ids):
+                    raise
+                app_logger.warning(f"刷新回复模板失败，继续使用缓存 sys_user_ids: {due_ids}: {e}")
+                return {sys_user_id: reply_cache.get(sys_user_id) for sys_user_id in sys_user_ids}
+            for sys_user_id in due_ids:
+                reply_cache.touch(sys_user_id)
+        return {sys_user_id: reply_cache.get(sys_user_id) for sys_user_id in sys_user_ids}
+    
+    async def _reply_fingerprints(self, sys_user_ids: List[int]) -> Dict[int, tuple]:
+        """每个租户模板的条数和校验和，用来判断模板是否有改动"""
+        res = await aio_mysql.execute_sql(f"""SELECT sys_user_id, COUNT(*) AS total, 
+            BIT_XOR(CRC32(CONCAT_WS('|', id, reply_type, content, media, buttons))) AS checksum 
+            FROM activity_reply WHERE sys_user_id IN ({','.join(str(i) for i in sys_user_ids)}) GROUP BY sys_user_id""")
+        if res.code != 200:
+            raise RuntimeError(f"获取回复模板指纹失败 sys_user_ids: {sys_user_ids}, res_sql: {res.msg}")
+        fingerprints = {}
+        for row in res.data or []:
+            fingerprints[int(row["sys_user_id"])] = (row["total"], row["checksum"])
+        return fingerprints
+    
+    async def _load_replies(self, sys_user_ids: List[int]) -> Dict[int, Dict[int, ActivityReply]]:
+        """一次 IN 查询加载多个租户的模板，按 sys_user_id 分组"""
+        res = await aio_mysql.execute_sql(f"SELECT * FROM activity_reply WHERE sys_user_id IN ({','.join(str(i) for i in sys_user_ids)})")
+        app_logger.info(f"批量获取回复模板: sys_user_ids: {sys_user_ids}, res_sql: {res.msg}")
+        if res.code != 200:
+            raise RuntimeError(f"批量获取回复模板失败 sys_user_ids: {sys_user_ids}, res_sql: {res.msg}")
+        templates: Dict[int, Dict[int, ActivityReply]] = {}
+        for activity_reply in res.data or []:
+            templates.setdefault(int(activity_reply["sys_user_id"]), {})[activity_reply["reply_type"]] = ActivityReply(
+                id=activity_reply["id"],
+                reply_type=activity_reply["reply_type"],
+                content=activity_reply["content"],
+                buttons=json.loads(activity_reply["buttons"]) if activity_reply["buttons"] else [],
+                media=activity_reply["media"],
+                sys_user_id=activity_reply["sys_user_id"],
+            )
+        return templates
+    
+    @staticmethod
+    def _live_conditions() -> List[str]:
+        """未结束、未终止、未删除的活动条件"""
+        return [
+            f"u.activity_status != {ActivityStatus.ENDED.value}",
+            f"u.activity_status != {ActivityStatus.KILLED.value}",
+            f"u.deleted_at IS NULL"
+        ]
+    
+    async def get_activities_version(self) -> tuple:
+        """进行中活动的条数和校验和，用于低成本检测活动是否有新增或修改"""
+        res = await aio_mysql.execute_sql(f"""SELECT COUNT(*) AS total, 
+            BIT_XOR(CRC32(CONCAT_WS('|', u.id, u.name, u.start_time, u.end_time, u.activity_status, u.sys_user_id, u.prizes, u.conditions, u.scope, u.checked))) AS checksum 
+            FROM activity_list u WHERE {' AND '.join(self._live_conditions())}""")
+        if res.code != 200 or not res.data:
+            raise RuntimeError(f"获取活动指纹失败 res_sql: {res.msg}")
+        return res.data[0]["total"], res.data[0]["checksum"]
+    
     async def get_all_activities(self, activity_id=0) -> List[Activity]:
         try:
             # 动态构建 WHERE 条件
-            where_conditions = []
-
             if not activity_id:
-                where_conditions.extend([
-                    f"u.activity_status != {ActivityStatus.ENDED.value}",
-                    f"u.activity_status != {ActivityStatus.KILLED.value}",
-                    f"u.deleted_at IS NULL"
-                ])
+                activities = await self._query_activities(self._live_conditions())
+                # 每次全量加载时重建索引
+                self.index_activities(activities)
             else:
-                where_conditions.append(f"u.id = {activity_id}")
-                
-            # 拼接完整 SQL
-            sql = f"""SELECT 
-                u.id,
-                u.name,
-                u.start_time,
-                u.end_time,
-                u.activity_status,
-                u.sys_user_id,
-                u.prizes,
-                u.conditions,
-                u.scope,
-                u.checked,
-                (
-                    SELECT JSON_ARRAYAGG(
-                        JSON_OBJECT('id', o.id, 'user_name', o.user_name, 'user_id', o.user_id, 'full_name', o.full_name, 'condition_status', o.condition_status, 'winning_status', o.winning_status, 'winning_content', o.winning_content, 'activity_id', o.activity_id, 'prize_level', o.prize_level)
-                    )
-                    FROM activity_user o 
-                    WHERE o.activity_id = u.id
-                ) as users
-            FROM activity_list u 
-            WHERE {' AND '.join(where_conditions)}"""
-            activities_data = await aio_mysql.execute_sql(sql)
-            
-            app_logger.info(f"获取所有抽奖活动 res_sql: {activities_data.msg}")
-            
-            activities = []
-            if activities_data.data:
-                for activity_data in activities_data.data:
-                    activities_reply = await self.get_all_reply(activity_data["sys_user_id"])
-                    conditions_data = json.loads(activity_data["conditions"])
-                    prices_data = json.loads(activity_data["prizes"])
-                    users = json.loads(activity_data["users"]) if activity_data["users"] else []
-                    
-                    # 条件
-                    conditions = [
-                        Condition(
-                            type=ConditionType(c["type"]),
-                            target_id=c["target_id"],
-                            target_id_link=c["target_id_link"],
-                            name=c["name"],
-                            button_name=c["button_name"]
-                        )
-                        for c in conditions_data
-                    ]
-                    
-                    # 奖品
-                    prices = [
-                        Price(
-                            prize_name=p["prize_name"],
-                            prize_content=p["prize_content"],
-                            prize_count=p["prize_count"]
-                        )
-                        for p in prices_data
-                    ]
-                    
-                    # 参与用户
-                    activity_users = [
-                        ActivityUser(
-                            id=p["id"],
-                            user_name=p["user_name"],
-                            full_name=p["full_name"],
-                            user_id=p["user_id"],
-                            condition_status=p["condition_status"],
-                            winning_status=p["winning_status"],
-                            winning_content=p["winning_content"],
-                            activity_id=p["activity_id"],
-                            prize_level=p["prize_level"]
-                        )
-                        for p in users
-                    ]
-                    
-                    # 活动
-                    activities.append(
-                        Activity(
-                            id=activity_data["id"],
-                            name=activity_data["name"],
-                            start_time=activity_data["start_time"],
-                            end_time=activity_data["end_time"],
-                            scope=activity_data["scope"],
-                            checked=activity_data["checked"],
-                            conditions=conditions,
-                            activities_reply=activities_reply,
-                            activity_users=activity_users,
-                            prices=prices,
-                            activity_status=activity_data["activity_status"],
-                            sys_user_id = activity_data["sys_user_id"]
-                        )
-                    )
+                activities = await self._query_activities([f"u.id = {activity_id}"])
             app_logger.info(f"获取所有抽奖活动: actyvity 共有：{len(activities)}个")
             return activities
         except Exception as e:
@@ -207,18 +276,152 @@ class InMemoryRepository(IDataRepository):
             async with DingTalk() as fetcher:
                 await fetcher.ding_talk_waring(f"{e}")
     
+    def index_activities(self, activities: List[Activity]) -> None:
+        self.activities = {activity.id: activity for activity in activities}
+    
+    async def _query_activities(self, where_conditions: List[str]) -> List[Activity]:
+        """按条件查询活动并解析（只加载活动头信息，参与用户通过 iter_activity_users 分页获取）"""
+        # 拼接完整 SQL
+        sql = f"""SELECT 
+            u.id,
+            u.name,
+            u.start_time,
+            u.end_time,
+            u.activity_status,
+            u.sys_user_id,
+            u.prizes,
+            u.conditions,
+            u.scope,
+            u.checked
+        FROM activity_list u 
+        WHERE {' AND '.join(where_conditions)}"""
+        activities_data = await aio_mysql.execute_sql(sql)
+        
+        app_logger.info(f"获取所有抽奖活动 res_sql: {activities_data.msg}")
+        
+        activities = []
+        if activities_data.data:
+            replies = await self.get_replies(row["sys_user_id"] for row in activities_data.data)
+            for activity_data in activities_data.data:
+                activities_reply = replies.get(int(activity_data["sys_user_id"]), {})
+                activities.append(self._build_activity(activity_data, activities_reply))
+        return activities
+    
+    @staticmethod
+    def _build_activity(activity_data: dict, activities_reply: Dict[int, ActivityReply]) -> Activity:
+        """数据库行解析为活动"""
+        conditions_data = json.loads(activity_data["conditions"])
+        prices_data = json.loads(activity_data["prizes"])
+        
+        # 条件
+        conditions = [
+            Condition(
+                type=ConditionType(c["type"]),
+                target_id=c["target_id"],
+                target_id_link=c["target_id_link"],
+                name=c["name"],
+                button_name=c["button_name"]
+            )
+            for c in conditions_data
+        ]
+        
+        # 奖品
+        prices = [
+            Price(
+                prize_name=p["prize_name"],
+                prize_content=p["prize_content"],
+                prize_count=p["prize_count"],
+                weight_by=p.get("weight_by", "")
+            )
+            for p in prices_data
+        ]
+        
+        # 活动
+        return Activity(
+            id=activity_data["id"],
+            name=activity_data["name"],
+            start_time=activity_data["start_time"],
+            end_time=activity_data["end_time"],
+            scope=activity_data["scope"],
+            checked=activity_data["checked"],
+            conditions=conditions,
+            activities_reply=activities_reply,
+            prices=prices,
+            activity_status=activity_data["activity_status"],
+            sys_user_id = activity_data["sys_user_id"]
+        )
+    
+    async def iter_activity_users(self, activity_id: int, after_id: int = 0, page_size: int = 500) -> AsyncIterator[ParticipantColumns]:
+        """按 activity_user.id 键集分页，逐页返回参与用户"""
+        last_id = after_id
+        while True:
+            res = await aio_mysql.execute_sql(f"SELECT id, user_name, user_id, full_name, condition_status, winning_status, winning_content, activity_id, prize_level \
+                FROM activity_user WHERE activity_id = {activity_id} AND id > {last_id} ORDER BY id LIMIT {page_size}")
+            if res.code != 200:
+                raise RuntimeError(f"分页获取活动参与用户失败: activity_id: {activity_id}, after_id: {last_id}, res_sql: {res.msg}")
+            page = ParticipantColumns.from_rows(res.data or [], activity_id)
+            if not page:
+                return
+            yield page
+            if len(page) < page_size:
+                return
+            last_id = page.ids[-1]
+    
     async def set_activity_status(self, activity_id: int, activity_status: int) -> None:
         res_sql = await aio_mysql.execute_sql(f"UPDATE activity_list SET activity_status = {activity_status} WHERE id={activity_id}")
         app_logger.info(f"设置活动状态 activity_id: {activity_id}, activity_status: {activity_status}, res_sql: {res_sql.msg}")
+        # 同步索引：结束或终止的活动不再按id查到
+        if activity_status in (ActivityStatus.ENDED.value, ActivityStatus.KILLED.value):
+            self.activities.pop(int(activity_id), None)
+        elif int(activity_id) in self.activities:
+            self.activities[int(activity_id)].activity_status = activity_status
     
     async def update_activity_detail(self, activity_id: int, user_id: int, condition_status: int) -> None:
         res_sql = await aio_mysql.execute_sql(f"UPDATE activity_user SET condition_status = {condition_status} WHERE activity_id={activity_id} AND user_id={user_id}")
         app_logger.info(f"更新活动用户条件状态 activity_id: {activity_id}, user_id: {user_id}, condition_status: {condition_status}, res_sql: {res_sql.msg}")
         
+    async def bulk_update_condition_status(self, activity_id: int, statuses: Dict[int, int], chunk_size: int = 500) -> None:
+        """批量更新用户条件状态 statuses: user_id -> condition_status，按状态分组、分块写入"""
+        grouped: Dict[int, List[int]] = {}
+        for user_id, condition_status in statuses.items():
+            grouped.setdefault(condition_status, []).append(user_id)
+        for condition_status, user_ids in grouped.items():
+            for i in range(0, len(user_ids), chunk_size):
+                chunk = user_ids[i:i + chunk_size]
+                res_sql = await aio_mysql.execute_sql(f"UPDATE activity_user SET condition_status = {condition_status} \
+                    WHERE activity_id={activity_id} AND user_id IN ({','.join(str(user_id) for user_id in chunk)})")
+                if res_sql.code != 200:
+                    raise RuntimeError(f"批量更新活动用户条件状态失败 activity_id: {activity_id}, res_sql: {res_sql.msg}")
+        app_logger.info(f"批量更新活动用户条件状态 activity_id: {activity_id}, 共 {len(statuses)} 个用户")
+    
     async def update_prize_user(self, prize_content: str, sql_id: int, prize_level: int) -> None:
         res_sql = await aio_mysql.execute_sql(f"UPDATE activity_user SET winning_status = 1, winning_content = '{prize_content}', prize_level={prize_level} WHERE id={sql_id}")
         app_logger.info(f"更新活动用户奖品状态内容 sql_id: {sql_id}, prize_content: {prize_content}, prize_level: {prize_level}, res_sql: {res_sql.msg}")
         
+    async def record_winners(self, activity_id: int, winners: List[tuple], chunk_size: int = 1000) -> None:
+        """批量写入中奖用户 winners: [(activity_user.id, 奖品内容, 奖品等级), ...]
+        
+        先清掉该活动之前残留的中奖标记，再分块写入，中途失败重抽时不会留下半套中奖名单
+        """
+        res_sql = await aio_mysql.execute_sql(f"UPDATE activity_user SET winning_status = 0, winning_content = '', prize_level = 0 \
+            WHERE activity_id = {activity_id} AND winning_status = 1")
+        if res_sql.code != 200:
+            raise RuntimeError(f"清除活动中奖记录失败 activity_id: {activity_id}, res_sql: {res_sql.msg}")
+        for i in range(0, len(winners), chunk_size):
+            chunk = winners[i:i + chunk_size]
+            content_cases = " ".join(f"WHEN {sql_id} THEN '{self._escape(prize_content)}'" for sql_id, prize_content, _ in chunk)
+            level_cases = " ".join(f"WHEN {sql_id} THEN {prize_level}" for sql_id, _, prize_level in chunk)
+            res_sql = await aio_mysql.execute_sql(f"UPDATE activity_user SET winning_status = 1, \
+                winning_content = CASE id {content_cases} END, prize_level = CASE id {level_cases} END \
+                WHERE activity_id = {activity_id} AND id IN ({','.join(str(sql_id) for sql_id, _, _ in chunk)})")
+            if res_sql.code != 200:
+                raise RuntimeError(f"批量写入中奖用户失败 activity_id: {activity_id}, res_sql: {res_sql.msg}")
+        app_logger.info(f"批量写入中奖用户 activity_id: {activity_id}, 共 {len(winners)} 个")
+    
+    @staticmethod
+    def _escape(value: str) -> str:
+        return str(value).replace("\\", "\\\\").replace("'", "\\'")
+    
     async def save_activity_detail(self, activity_id: int, message: dict) -> None:
         try:
             from_data = message.get("from", {})
@@ -251,6 +454,8 @@ class InMemoryRepository(IDataRepository):
         
     async def update_activity_checked(self, activity_id: str, checked: int) -> None:
         await aio_mysql.execute_sql(f"UPDATE activity_list SET checked = {checked} WHERE id={activity_id}")
+        if int(activity_id) in self.activities:
+            self.activities[int(activity_id)].checked = checked
         
     async def get_winning_user(self, activity_id: str) -> list:
         res_user = await aio_mysql.execute_sql(f"SELECT * FROM activity_user WHERE activity_id = {activity_id} AND winning_status=1 ORDER BY prize_level")
@@ -268,4 +473,196 @@ class InMemoryRepository(IDataRepository):
     
     async def get_close_activity_by_id(self, activity_id: str) -> Optional[Activity]:
         res = await self.get_all_activities(activity_id)
-        return res
\ No newline at end of file
+        return res
+
+
+class ActivityCache:
+    """进程内活动缓存（TTL + LRU），写操作通过版本号使进行中的回源结果失效"""
+    
+    LIVE_KEY = "live"
+    
+    def __init__(self, maxsize: int = 1024, ttl: float = 30.0):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.versions: Dict[int, int] = {}
+        self.global_version = 0
+        self.generation = 0  # 任何写操作都加一，写之后发起的查询不合并到写之前的请求
+        self.activities_version = None  # 最近一次看到的活动表指纹
+    
+    def version(self, activity_id: int) -> tuple:
+        return self.global_version, self.versions.get(activity_id, 0)
+    
+    def get(self, activity_id: int) -> Optional[Activity]:
+        return self.entries.get(activity_id)
+    
+    def put(self, activity: Activity, version: tuple) -> None:
+        """回源期间没有写操作时才写入"""
+        if self.version(activity.id) == version:
+            self.entries.set(activity.id, activity)
+    
+    def get_live(self) -> Optional[List[Activity]]:
+        activity_ids = self.entries.get(self.LIVE_KEY)
+        if activity_ids is None:
+            return None
+        activities = [self.entries.peek(activity_id) for activity_id in activity_ids]
+        if any(activity is None for activity in activities):
+            return None
+        return activities
+    
+    def snapshot(self) -> tuple:
+        """回源开始时记录版本，回源结束后用来判断哪些活动期间被写过"""
+        return self.global_version, dict(self.versions)
+    
+    def put_live(self, activities: List[Activity], snapshot: tuple) -> None:
+        """回源期间被写过的活动不写入（缓存里没有时 get_live 会重新回源）"""
+        global_version, versions = snapshot
+        if self.global_version != global_version:
+            return
+        for activity in activities:
+            if self.versions.get(activity.id, 0) == versions.get(activity.id, 0):
+                self.entries.set(activity.id, activity)
+        self.entries.set(self.LIVE_KEY, [activity.id for activity in activities])
+    
+    def patch(self, activity_id: int, **fields) -> None:
+        # 版本号也要变，防止回源中的旧数据覆盖这次修改
+        self.versions[activity_id] = self.versions.get(activity_id, 0) + 1
+        self.generation += 1
+        activity = self.entries.peek(activity_id)
+        if activity:
+            for name, value in fields.items():
+                setattr(activity, name, value)
+    
+    def invalidate(self, activity_id: int) -> None:
+        self.versions[activity_id] = self.versions.get(activity_id, 0) + 1
+        self.generation += 1
+        self.entries.pop(activity_id)
+        self.entries.pop(self.LIVE_KEY)
+    
+    def invalidate_all(self) -> None:
+        self.global_version += 1
+        self.generation += 1
+        self.versions.clear()
+        self.entries.clear()
+    
+    def stats(self) -> Dict:
+        return self.entries.stats()
+
+
+# 进程内共享的活动缓存，调度器和各回调共用
+activity_cache = ActivityCache()
+# 进程内共享的请求合并，各 CachedRepository 实例的相同查询合并为一次
+repository_flight = SingleFlight()
+
+
+class CachedRepository(IDataRepository):
+    """带缓存的数据仓储，读穿透到内部仓储，写操作同步更新或失效缓存"""
+    
+    def __init__(self, repository: IDataRepository, cache: ActivityCache = None, flight: SingleFlight = None):
+        self.repository = repository
+        self.cache = cache or activity_cache
+        self.flight = flight or repository_flight
+    
+    async def get_activity_by_id(self, activity_id: str) -> Optional[Activity]:
+        activity_id = int(activity_id)
+        activity = self.cache.get(activity_id)
+        if activity:
+            return activity
+        version = self.cache.version(activity_id)
+        activity = await self.repository.get_activity_by_id(activity_id)
+        if activity:
+            self.cache.put(activity, version)
+        return activity
+    
+    async def get_all_activities(self, activity_id=0) -> List[Activity]:
+        if activity_id:
+            # 指定id的查询用于重新加载或查已结束活动，直接回源
+            return await self.repository.get_all_activities(activity_id)
+        activities = self.cache.get_live()
+        if activities is not None:
+            return activities
+        activities = await self.flight.do(("get_all_activities", self.cache.generation), self._load_live_activities)
+        if activities is not None:
+            # 合并的请求可能在别的仓储实例上执行，本实例的索引也要按结果重建
+            self.repository.index_activities(activities)
+        return activities
+    
+    async def _load_live_activities(self) -> List[Activity]:
+        snapshot = self.cache.snapshot()
+        activities = await self.repository.get_all_activities()
+        if activities is not None:
+            self.cache.put_live(activities, snapshot)
+        return activities
+    
+    async def get_activities_version(self) -> tuple:
+        """活动指纹变化说明有其他进程修改了活动，整体失效缓存"""
+        version = await self.repository.get_activities_version()
+        if version != self.cache.activities_version:
+            if self.cache.activities_version is not None:
+                self.cache.invalidate_all()
+            self.cache.activities_version = version
+        return version
+    
+    async def get_all_reply(self, sys_user_id):
+        return await self.repository.get_all_reply(sys_user_id)
+    
+    async def iter_activity_users(self, activity_id: int, after_id: int = 0, page_size: int = 500) -> AsyncIterator[ParticipantColumns]:
+        async for page in self.repository.iter_activity_users(activity_id, after_id, page_size):
+            yield page
+    
+    async def set_activity_status(self, activity_id: int, activity_status: int) -> None:
+        await self.repository.set_activity_status(activity_id, activity_status)
+        if activity_status in (ActivityStatus.ENDED.value, ActivityStatus.KILLED.value):
+            self.cache.invalidate(int(activity_id))
+        else:
+            self.cache.patch(int(activity_id), activity_status=activity_status)
+    
+    async def save_activity_detail(self, activity_id: int, message: dict) -> None:
+        # 参与用户不在活动头信息里，新增参与记录不影响缓存的活动
+        return await self.repository.save_activity_detail(activity_id, message)
+    
+    async def update_activity_detail(self, activity_id: int, user_id: int, condition_status: int) -> None:
+        return await self.repository.update_activity_detail(activity_id, user_id, condition_status)
+    
+    async def bulk_update_condition_status(self, activity_id: int, statuses: Dict[int, int]) -> None:
+        await self.repository.bulk_update_condition_status(activity_id, statuses)
+    
+    async def update_prize_user(self, prize_content: str, sql_id: int, prize_level: int) -> None:
+        res = await self.repository.update_prize_user(prize_content, sql_id, prize_level)
+        # 只有参与记录id，无法定位活动，整体失效
+        self.cache.invalidate_all()
+        return res
+    
+    async def record_winners(self, activity_id: int, winners: List[tuple]) -> None:
+        await self.repository.record_winners(activity_id, winners)
+        self.cache.invalidate(int(activity_id))
+    
+    async def get_groups_by_tag(self, tag, sys_user_id) -> list:
+        return await self.flight.do(
+            ("get_groups_by_tag", str(tag), str(sys_user_id)),
+            lambda: self.repository.get_groups_by_tag(tag, sys_user_id)
+        )
+    
+    async def get_user_participation(self, user_id: str, activity_id: str) -> Dict:
+        return await self.repository.get_user_participation(user_id, activity_id)
+    
+    async def save_user_participation(self, user_id: str, activity_id: str, data: Dict) -> None:
+        await self.repository.save_user_participation(user_id, activity_id, data)
+    
+    async def update_activity_checked(self, activity_id: str, checked: int) -> None:
+        await self.repository.update_activity_checked(activity_id, checked)
+        self.cache.patch(int(activity_id), checked=checked)
+    
+    async def get_winning_user(self, activity_id: str) -> list:
+        return await self.flight.do(
+            ("get_winning_user", str(activity_id), self.cache.version(int(activity_id))),
+            lambda: self.repository.get_winning_user(activity_id)
+        )
+    
+    async def get_finish_conditions_user(self, activity_id: str, tg_user_id) -> list:
+        return await self.repository.get_finish_conditions_user(activity_id, tg_user_id)
+    
+    async def get_close_activity_by_id(self, activity_id: str) -> Optional[Activity]:
+        return await self.repository.get_close_activity_by_id(activity_id)
+    
+    def cache_stats(self) -> Dict:
+        """缓存命中和请求合并统计"""
+        return {**self.cache.stats(), "singleflight": self.flight.stats()}
@@ -0,0 +1,95 @@
+import random
+import secrets
+from array import array
+from typing import List, Set
+
+
+class DrawEngine:
+    """抽奖引擎：种子可指定并记录在日志里，同样的种子和候选顺序可以完整重放一次抽奖"""
+
+    def __init__(self, seed: int = None):
+        self.seed = secrets.randbits(63) if seed is None else int(seed)
+        self.rng = random.Random(self.seed)
+
+    def draw(self, population: int, counts: List[int]) -> List[List[int]]:
+        """在 [0, population) 的下标数组上做一次部分 Fisher–Yates 洗牌，
+        洗出的前缀依次切给每个奖项，返回每个奖项的中奖下标；O(population)"""
+        total = min(sum(counts), population)
+        indexes = array("q", range(population))
+        randbelow = self.rng.randrange
+        for i in range(total):
+            j = i + randbelow(population - i)
+            indexes[i], indexes[j] = indexes[j], indexes[i]
+        tiers = []
+        start = 0
+        for count in counts:
+            end = min(start + count, total)
+            tiers.append(indexes[start:end].tolist())
+            start = end
+        return tiers
+
+    def weighted_sampler(self, weights: List[float], taken: Set[int] = None) -> "AliasSampler":
+        return AliasSampler(weights, self.rng, taken)
+
+
+class AliasSampler:
+    """按权重不放回抽样：Vose 别名表 O(n) 构建后每次抽取 O(1)；抽到已中奖的下标就拒绝重抽，
+    已中奖的权重占比变大导致拒绝过多时，去掉已中奖的下标重建别名表。
+    taken 可以在多个抽样器之间共享（不同奖项按不同权重抽，但同一个人只能中一次）"""
+
+    def __init__(self, weights: List[float], rng: random.Random, taken: Set[int] = None):
+        self.weights = weights
+        self.rng = rng
+        self.taken = taken if taken is not None else set()
+        self.rebuilds = 0
+        self._build()
+
+    def _build(self) -> None:
+        candidates = [i for i, weight in enumerate(self.weights) if i not in self.taken and weight > 0]
+        if not candidates:
+            # 剩下的人权重都是0时按等概率抽
+            candidates = [i for i in range(len(self.weights)) if i not in self.taken]
+            weights = [1.0] * len(candidates)
+        else:
+            weights = [float(self.weights[i]) for i in candidates]
+        size = len(candidates)
+        total = sum(weights)
+        prob = array("d", (weight * size / total for weight in weights)) if size else array("d")
+        alias = array("q", range(size))
+        small = [i for i in range(size) if prob[i] < 1.0]
+        large = [i for i in range(size) if prob[i] >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            alias[less] = more
+            prob[more] = prob[more] + prob[less] - 1.0
+            (small if prob[more] < 1.0 else large).append(more)
+        for i in small + large:
+            prob[i] = 1.0
+        self._candidates = array("q", candidates)
+        self._prob = prob
+        self._alias = alias
+        self._accepted = 0
+        self._rejected = 0
+        self.rebuilds += 1
+
+    def _sample(self) -> int:
+        slot = int(self.rng.random() * len(self._candidates))
+        if self.rng.random() >= self._prob[slot]:
+            slot = self._alias[slot]
+        return self._candidates[slot]
+
+    def pick(self, count: int) -> List[int]:
+        picked = []
+        while len(picked) < count and len(self.taken) < len(self.weights):
+            if not self._candidates or self._rejected > self._accepted + 16:
+                self._build()
+                if not self._candidates:
+                    break
+            index = self._sample()
+            if index in self.taken:
+                self._rejected += 1
+                continue
+            self._accepted += 1
+            self.taken.add(index)
+            picked.append(index)
+        return picked
@@ -0,0 +1,169 @@
+import asyncio
+import time
+from typing import Dict, List
+
+from app.lottery_activity_handler.data_class import ConditionType, ParticipantColumns
+from app.lottery_activity_handler.validator import ConditionValidatorFactory, FollowBotValidator, ValidationSession, membership_cache
+from app.lottery_activity_handler.verification import verification_tracker
+from app.lottery_activity_handler.logger_handler import app_logger
+
+
+def _mask_of(indexes, size: int) -> int:
+    """先在 bytearray 上置位再一次性转成整数，避免对大整数逐位或运算"""
+    buf = bytearray((size + 7) // 8)
+    for index in indexes:
+        buf[index >> 3] |= 1 << (index & 7)
+    return int.from_bytes(buf, "little")
+
+
+def _indexes_of(mask: int) -> List[int]:
+    indexes = []
+    for offset, byte in enumerate(mask.to_bytes((mask.bit_length() + 7) // 8, "little")):
+        if byte:
+            base = offset << 3
+            indexes.extend(base + bit for bit in range(8) if byte >> bit & 1)
+    return indexes
+
+
+def _popcount(mask: int) -> int:
+    return bin(mask).count("1")
+
+
+class EligibilityResult:
+    """整个活动的合格情况：每个条件一个位图（第 i 位对应参与用户下标 i），按位与得到合格集合"""
+
+    def __init__(self, participants: ParticipantColumns, eligible: int, condition_masks: Dict[str, int], checked: int, fresh: int):
+        self.participants = participants
+        self.eligible = eligible
+        self.condition_masks = condition_masks  # 条件 -> 通过的位图（只包含本次验证的用户）
+        self.checked = checked  # 本次实际验证的用户位图
+        self.fresh = fresh  # 沿用上次有效结果的用户数
+
+    def eligible_indexes(self) -> List[int]:
+        return _indexes_of(self.eligible)
+
+    def eligible_participants(self) -> ParticipantColumns:
+        return self.participants.take(self.eligible_indexes())
+
+    def stats(self) -> Dict:
+        return {
+            "participants": len(self.participants),
+            "checked": _popcount(self.checked),
+            "fresh": self.fresh,
+            "passed": {name: _popcount(mask) for name, mask in self.condition_masks.items()},
+            "eligible": _popcount(self.eligible)
+        }
+
+
+class EligibilityEngine:
+    """批量计算整个活动的合格用户：按条件整体计算位图，不再逐个用户验证；
+    条件按统计的耗时和失败率排序，后面的条件只验证前面都通过的用户"""
+
+    OUTAGE_MIN_FAILURES = 20  # 全部失败且失败数达到这个数才当作依赖不可用，用户少时按不合格处理
+    OUTAGE_MAX_RETRIES = 3  # 同一活动同一条件连续因依赖不可用中止的次数上限，超过后按不合格处理完成开奖
+
+    def __init__(self, validator: ConditionValidatorFactory, concurrency: int = 20):
+        self.validator = validator
+        self.concurrency = concurrency
+        self._outages: Dict[tuple, int] = {}  # (activity_id, 条件) -> 连续中止次数
+
+    async def evaluate(self, session: ValidationSession, participants: ParticipantColumns, freshness: float = 0.0) -> EligibilityResult:
+        """freshness 秒内验证过且之后没有相关事件的用户沿用上次结果"""
+        activity = session.activity
+        size = len(participants)
+        now = time.monotonic()
+        started_at = now
+        fresh_indexes = []
+        pending_indexes = []
+        fresh = 0
+        for index, user_id in enumerate(participants.user_ids):
+            result = verification_tracker.fresh_result(activity.id, user_id, freshness, now) if freshness else None
+            if result is None:
+                pending_indexes.append(index)
+            else:
+                fresh += 1
+                if result:
+                    fresh_indexes.append(index)
+        fresh_pass = _mask_of(fresh_indexes, size)
+        pending = _mask_of(pending_indexes, size)
+
+        checked = pending
+        condition_masks: Dict[str, int] = {}
+        conditions = [condition for condition in activity.conditions if ConditionValidatorFactory.get_validator(condition.type)]
+        for condition in self.validator.condition_stats.order(conditions):
+            if not pending:
+                break
+            indexes = _indexes_of(pending)
+            condition_started_at = time.monotonic()
+            passed = await self._condition_mask(condition, session, participants, indexes, size)
+            self.validator.condition_stats.record_batch(condition.type, time.monotonic() - condition_started_at, len(indexes), _popcount(passed))
+            name = f"{condition.type.value}:{condition.target_id}"
+            condition_masks[name] = condition_masks.get(name, passed) & passed
+            pending &= passed
+
+        eligible = fresh_pass | pending
+        passed_indexes = set(_indexes_of(pending))
+        for index in pending_indexes:
+            verification_tracker.record(activity.id, participants.user_ids[index], index in passed_indexes, started_at)
+        result = EligibilityResult(participants, eligible, condition_masks, checked, fresh)
+        app_logger.info(f"活动合格用户批量计算 activity_id: {activity.id}, 结果: {result.stats()}")
+        return result
+
+    async def _condition_mask(self, condition, session: ValidationSession, participants: ParticipantColumns, indexes: List[int], size: int) -> int:
+        if condition.type == ConditionType.SPEECH_COUNT:
+            return await self._speech_mask(condition, session, participants, indexes, size)
+        if condition.type == ConditionType.FOLLOW_BOT:
+            validator = ConditionValidatorFactory.get_validator(condition.type)
+            user_ids = [participants.user_ids[index] for index in indexes]
+            results = await validator.validate_many(condition, user_ids, session.sys_user_id) if isinstance(validator, FollowBotValidator) else {}
+            self._check_failures(session, condition, sum(1 for user_id in user_ids if results.get(user_id) is None), len(user_ids))
+            return _mask_of((index for index, user_id in zip(indexes, user_ids) if results.get(user_id)), size)
+        return await self._membership_mask(condition, session, participants, indexes, size)
+
+    def _check_failures(self, session: ValidationSession, condition, failed: int, total: int) -> None:
+        """单个用户查询失败只算这个用户不合格；足够多的用户全部失败说明依赖不可用，中止本次开奖等待重试，
+        连续中止超过 OUTAGE_MAX_RETRIES 次后不再重试，失败的用户按不合格处理"""
+        key = (session.activity.id, condition.type.value, condition.target_id)
+        if failed:
+            app_logger.warning(f"批量验证{condition.type.value}条件 target_id: {condition.target_id} 有 {failed}/{total} 个用户查询失败")
+        if not failed or failed < total or failed < self.OUTAGE_MIN_FAILURES:
+            self._outages.pop(key, None)
+            return
+        retries = self._outages.get(key, 0)
+        if retries >= self.OUTAGE_MAX_RETRIES:
+            self._outages.pop(key, None)
+            app_logger.error(f"批量验证{condition.type.value}条件连续 {retries} 次全部失败 target_id: {condition.target_id}, 失败用户按不合格处理")
+            return
+        self._outages[key] = retries + 1
+        raise RuntimeError(f"批量验证{condition.type.value}条件全部失败 target_id: {condition.target_id}, 第 {retries + 1} 次")
+
+    @staticmethod
+    async def _speech_mask(condition, session: ValidationSession, participants: ParticipantColumns, indexes: List[int], size: int) -> int:
+        counts = await session.load_speech_counts()
+        groups = [int(group) for group in condition.target_id.split(',') if group]
+        target = int(condition.target_id_link)
+        return _mask_of((
+            index for index in indexes
+            if all(counts.get(participants.user_ids[index], {}).get(group, 0) >= target for group in groups)
+        ), size)
+
+    async def _membership_mask(self, condition, session: ValidationSession, participants: ParticipantColumns, indexes: List[int], size: int) -> int:
+        """加群/频道只能逐个请求 getChatMember，走共享的成员关系缓存并限制并发"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        failed = 0
+
+        async def is_member(user_id) -> bool:
+            nonlocal failed
+            async with semaphore:
+                try:
+                    return await membership_cache.is_member(condition.target_id, user_id, lambda: session.first_bot(condition))
+                except Exception as e:
+                    failed += 1
+                    app_logger.error(f"批量验证{condition.type.value}条件失败 target_id: {condition.target_id}, tg_user_id: {user_id}: {e}")
+                    return False
+
+        results = []
+        for start in range(0, len(indexes), 1000):
+            results.extend(await asyncio.gather(*[is_member(participants.user_ids[index]) for index in indexes[start:start + 1000]]))
+        self._check_failures(session, condition, failed, len(indexes))
+        return _mask_of((index for index, passed in zip(indexes, results) if passed), size)
@@ -4,11 +4,12 @@ from utils.common import bot_send_message, parser_text
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
-from mysql.aio import aio_mysql
 from helper import *
 from app.lottery_activity_handler.activity_scheduler import *
 from app.lottery_activity_handler.data_repository import *
 from app.lottery_activity_handler.validator import *
+from app.lottery_activity_handler.speech_count import speech_count_engine, speech_count_ingest
+from app.lottery_activity_handler.rate_limiter import RateLimitedBot
 from app.lottery_activity_handler.logger_handler import app_logger
 
 
@@ -18,6 +19,7 @@ class LotteryService:
     def __init__(self, repository: IDataRepository, bot_, message):
         self.repository = repository
         self.bot, self.sys_user_id, self.first_name, self.language = bot_
+        self.bot = RateLimitedBot(self.bot)
         self.message = message
     
     async def get_active_activities(self) -> List[Activity]:
@@ -173,18 +175,16 @@ class TelegramBotHandler:
         """处理条件选择(发言次数检查)"""
         try:
             activity = await self.lottery_service.repository.get_activity_by_id(activity_id)
+            user_id = self.lottery_service.message["from"]["id"]
+            counts = await speech_count_engine.get_user_counts(activity, user_id)
             for condition in activity.conditions:
                 if condition.type.value == "speech_count":
                     groups = condition.target_id.split(',')
                     text = ""
-                    user_id = self.lottery_service.message["from"]["id"]
                     for group in groups:
-                        activities_reply_data = await aio_mysql.execute_sql(f"SELECT * FROM chat_messages_logs WHERE user_id={user_id} AND chat_id={group} AND created_at>'{activity.start_time}' AND created_at<'{activity.end_time}'")
-                        if not activities_reply_data.code:
-                            app_logger.info(f"选择条件选择回调执行sql异常: sql: {activities_reply_data.msg}")
-                        activities_reply_data = activities_reply_data.data
-                        if activities_reply_data:
-                            text += f"群发言次数：{activities_reply_data[0]['chat_title']}, 当前次数：{len(activities_reply_data)}, 达标次数：{condition.target_id_link}\n"
+                        times = counts.get(int(group), 0)
+                        if times:
+                            text += f"群发言次数：{speech_count_engine.titles.get(int(group)) or get_group(group)['group_name']}, 当前次数：{times}, 达标次数：{condition.target_id_link}\n"
                         else:
                             text += f"群发言次数：{get_group(group)['group_name']}, 当前次数：{0}, 达标次数：{condition.target_id_link}\n"
             callback_query_id = self.lottery_service.message["id"]
@@ -277,7 +277,7 @@ class LotterySystem:
     
     def __init__(self, bot_, message):
         self.bot, self.created_by, self.first_name, self.language = bot_
-        self.repository = InMemoryRepository()
+        self.repository = CachedRepository(InMemoryRepository())
         self.lottery_service = LotteryService(self.repository, bot_, message)
         self.validator = ConditionValidatorFactory()
         self.bot_handler = TelegramBotHandler(self.lottery_service, self.validator)
@@ -287,4 +287,33 @@ class LotterySystem:
 async def callback_query_func(bot_, message):
     """按钮回调处理"""
     lottery_sys = LotterySystem(bot_, message)
-    await lottery_sys.bot_handler.callback_query_handler()
\ No newline at end of file
+    await lottery_sys.bot_handler.callback_query_handler()
+
+
+async def start_command_func(bot_, message):
+    """/start 命令处理：用户私聊机器人即关注了机器人，先让关注条件的缓存结果失效"""
+    ConditionValidatorFactory.get_validator(ConditionType.FOLLOW_BOT).invalidate(message["from"]["id"])
+    lottery_sys = LotterySystem(bot_, message)
+    await lottery_sys.bot_handler.start_command()
+
+
+async def group_message_func(bot_, message):
+    """群消息处理：发言计数；进群/退群的服务消息让成员关系缓存失效"""
+    chat_id = message.get("chat", {}).get("id")
+    for member in message.get("new_chat_members") or []:
+        membership_cache.invalidate(chat_id, member["id"])
+    if message.get("left_chat_member"):
+        membership_cache.invalidate(chat_id, message["left_chat_member"]["id"])
+    await speech_count_ingest(message)
+
+
+async def chat_member_func(bot_, message):
+    """chat_member / my_chat_member 更新处理：群和频道成员变化让成员关系缓存失效，私聊里屏蔽/解除屏蔽机器人让关注条件失效"""
+    chat = message.get("chat", {})
+    user_id = message.get("new_chat_member", {}).get("user", {}).get("id")
+    if not user_id:
+        return
+    if chat.get("type") == "private":
+        ConditionValidatorFactory.get_validator(ConditionType.FOLLOW_BOT).invalidate(chat["id"])
+    else:
+        membership_cache.invalidate(chat.get("id"), user_id)
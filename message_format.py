@@ -46,10 +46,10 @@ class IMessageData(ABC):
 class InMessageFormat(IMessageData):
     """消息格式化实现"""
     
-    async def __init__(self, activity: Activity, repository: IDataRepository):
+    def __init__(self, activity: Activity, repository: IDataRepository):
         self.activity = activity
         self.repository = repository
-        self.reply = await self.reply_message_format()
+        self.reply = None  # 第一次格式化时加载（中奖名单需要查库）
         self.numbers = [
                         "1️⃣", "2️⃣", "3️⃣", "4️⃣", "5️⃣", "6️⃣", "7️⃣", "8️⃣", "9️⃣", "🔟",
                         "1️⃣1️⃣", "1️⃣2️⃣", "1️⃣3️⃣", "1️⃣4️⃣", "1️⃣5️⃣", "1️⃣6️⃣", "1️⃣7️⃣", "1️⃣8️⃣", "1️⃣9️⃣", "2️⃣0️⃣",
@@ -100,6 +100,8 @@ class InMessageFormat(IMessageData):
                 "end_time": self.activity.end_time}
     
     async def content_format(self, content) -> str:
+        if self.reply is None:
+            self.reply = await self.reply_message_format()
         return content.format(PRIZE_DRAW_NAME=self.reply["name"], 
                             PRIZE_CONTENT=self.reply["prize_content"], 
                             WINNING_TIME=self.reply["end_time"], 
@@ -0,0 +1,154 @@
+import asyncio
+import time
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from telegram import Bot
+from telegram.error import RetryAfter
+
+from app.lottery_activity_handler.cache import TTLCache
+from app.lottery_activity_handler.logger_handler import app_logger
+
+
+class TokenBucket:
+    """令牌桶，按顺序排队取令牌，可被 retry_after 整体暂停"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.waiting = 0
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    def pause(self, seconds: float) -> None:
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self) -> None:
+        self.waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    if self._paused_until > now:
+                        await asyncio.sleep(self._paused_until - now)
+                        continue
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+        finally:
+            self.waiting -= 1
+
+
+class TelegramRateLimiter:
+    """Telegram 调用限流：每个机器人一个总令牌桶，发消息类调用再按目标会话限流；
+    遇到 429 按 retry_after 暂停后重新排队，不当作失败"""
+
+    BOT_RATE = 30  # 每个机器人每秒约 30 次
+    PRIVATE_CHAT_RATE = 1  # 同一私聊每秒 1 条
+    GROUP_CHAT_RATE = 20 / 60  # 同一群每分钟 20 条
+    CHAT_LIMITED_PREFIXES = ("send_", "edit_message_", "copy_message", "forward_message")
+
+    def __init__(self, max_retries: int = 5):
+        self.max_retries = max_retries
+        self._bot_buckets: Dict[str, TokenBucket] = {}
+        self._chat_buckets = TTLCache(maxsize=50000, ttl=600)
+        self.retried = 0
+
+    def _bot_bucket(self, token: str) -> TokenBucket:
+        bucket = self._bot_buckets.get(token)
+        if bucket is None:
+            bucket = self._bot_buckets[token] = TokenBucket(self.BOT_RATE, self.BOT_RATE)
+        return bucket
+
+    def _chat_bucket(self, token: str, chat_id) -> TokenBucket:
+        key = (token, str(chat_id))
+        bucket = self._chat_buckets.peek(key)
+        if bucket is None:
+            if str(chat_id).startswith("-"):
+                bucket = TokenBucket(self.GROUP_CHAT_RATE, 3)
+            else:
+                bucket = TokenBucket(self.PRIVATE_CHAT_RATE, 1)
+        # 每次使用都续期，空闲的会话桶自然过期
+        self._chat_buckets.set(key, bucket)
+        return bucket
+
+    @staticmethod
+    def _retry_seconds(error: RetryAfter) -> float:
+        retry_after = error.retry_after
+        if isinstance(retry_after, timedelta):
+            return retry_after.total_seconds()
+        return float(retry_after)
+
+    async def call(self, token: str, method_name: str, chat_id: Optional[Any], request: Callable[[], Awaitable]) -> Any:
+        """request 每次重试都重新调用，生成新的请求协程"""
+        chat_limited = chat_id is not None and method_name.startswith(self.CHAT_LIMITED_PREFIXES)
+        for attempt in range(self.max_retries + 1):
+            bot_bucket = self._bot_bucket(token)
+            chat_bucket = self._chat_bucket(token, chat_id) if chat_limited else None
+            if chat_bucket:
+                await chat_bucket.acquire()
+            await bot_bucket.acquire()
+            try:
+                return await request()
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                seconds = self._retry_seconds(e)
+                bot_bucket.pause(seconds)
+                if chat_bucket:
+                    chat_bucket.pause(seconds)
+                self.retried += 1
+                app_logger.warning(f"Telegram 限流 method: {method_name}, chat_id: {chat_id}, retry_after: {seconds}s, 第 {attempt + 1} 次重新排队")
+
+    def queue_depth(self) -> Dict:
+        """各令牌桶排队中的调用数"""
+        return {
+            "bots": {token[:10]: bucket.waiting for token, bucket in self._bot_buckets.items() if bucket.waiting},
+            "chats": sum(self._chat_buckets.peek(key).waiting for key in self._chat_buckets.keys() if self._chat_buckets.peek(key)),
+            "retried": self.retried
+        }
+
+
+class RateLimitedBot:
+    """telegram.Bot 代理，所有异步 API 调用经过限流器；记录最近一次调用时间和进行中的调用数，连接池按实际使用回收"""
+
+    def __init__(self, bot: Bot, limiter: "TelegramRateLimiter" = None):
+        self._bot = bot
+        self._limiter = limiter or rate_limiter
+        self.last_used = time.monotonic()
+        self.in_flight = 0
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._bot, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        async def limited(*args, **kwargs):
+            chat_id = kwargs.get("chat_id", args[0] if args else None)
+            self.in_flight += 1
+            try:
+                return await self._limiter.call(self._bot.token, name, chat_id, lambda: attr(*args, **kwargs))
+            finally:
+                self.in_flight -= 1
+                self.last_used = time.monotonic()
+        return limited
+
+    def idle_for(self, now: float) -> float:
+        """没有进行中的调用时距上次调用的秒数，有调用进行中返回 0"""
+        return 0.0 if self.in_flight else now - self.last_used
+
+    def __repr__(self) -> str:
+        return f"RateLimitedBot({self._bot!r})"
+
+
+# 进程内共享的限流器
+rate_limiter = TelegramRateLimiter()
@@ -0,0 +1,40 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class SingleFlight:
+    """合并相同请求：同一个 key 已有请求在进行中时，后来的调用直接等待同一个结果，不再重复查库或请求 Telegram"""
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.calls = 0  # 实际发起的请求数
+        self.coalesced = 0  # 合并到进行中请求的调用数
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]) -> Any:
+        """func 只在没有进行中的相同请求时调用；异常同样传给所有等待方"""
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            future = asyncio.ensure_future(func())
+            self._inflight[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+        # 某个等待方被取消不影响请求本身和其他等待方
+        return await asyncio.shield(future)
+
+    def _forget(self, key: Hashable, future: asyncio.Future) -> None:
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+        if not future.cancelled():
+            # 所有等待方都已取消时避免 "exception was never retrieved"
+            future.exception()
+
+    def stats(self) -> Dict:
+        total = self.calls + self.coalesced
+        return {
+            "inflight": len(self._inflight),
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "coalesce_rate": round(self.coalesced / total, 4) if total else 0.0
+        }
@@ -0,0 +1,256 @@
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from mysql.aio import aio_mysql
+from app.lottery_activity_handler.cache import TTLCache
+from app.lottery_activity_handler.data_class import Activity, ConditionType
+from app.lottery_activity_handler.data_repository import IDataRepository, InMemoryRepository, CachedRepository
+from app.lottery_activity_handler.verification import verification_tracker
+from app.lottery_activity_handler.logger_handler import app_logger
+
+# 发言计数表，(activity_id, 0, 0) 为哨兵行，表示该活动计数已初始化，可以直接读取
+COUNTER_TABLE = "activity_speech_counter"
+
+
+class SpeechCountEngine:
+    """发言次数统计，一个活动只做一次 GROUP BY 聚合，结果按 用户 -> 群 -> 次数 保存"""
+
+    def __init__(self, ttl: float = 60.0):
+        self.counts = TTLCache(maxsize=256, ttl=ttl)  # activity_id -> {user_id: {chat_id: 次数}}
+        self.titles: Dict[int, str] = {}  # chat_id -> 群名
+
+    @staticmethod
+    def speech_groups(activity: Activity) -> List[int]:
+        """活动发言条件涉及的所有群"""
+        groups = []
+        for condition in activity.conditions:
+            if condition.type == ConditionType.SPEECH_COUNT:
+                groups.extend(int(group) for group in condition.target_id.split(',') if group)
+        return list(dict.fromkeys(groups))
+
+    async def _aggregate(self, activity: Activity, user_id: int = None) -> Dict[int, Dict[int, int]]:
+        """优先读增量计数器，计数器未初始化时回退到聚合消息日志"""
+        counts = await speech_counter_store.read(activity.id, user_id)
+        if counts is None:
+            counts = await self._aggregate_logs(activity, user_id)
+        return counts
+
+    async def _aggregate_logs(self, activity: Activity, user_id: int = None) -> Dict[int, Dict[int, int]]:
+        groups = self.speech_groups(activity)
+        if not groups:
+            return {}
+        where_conditions = [
+            f"chat_id IN ({','.join(str(group) for group in groups)})",
+            f"created_at>'{activity.start_time}'",
+            f"created_at<'{activity.end_time}'"
+        ]
+        if user_id is not None:
+            where_conditions.append(f"user_id={user_id}")
+        res = await aio_mysql.execute_sql(f"SELECT user_id, chat_id, COUNT(*) AS times, MAX(chat_title) AS chat_title \
+            FROM chat_messages_logs WHERE {' AND '.join(where_conditions)} GROUP BY user_id, chat_id")
+        if res.code != 200:
+            raise RuntimeError(f"发言次数统计失败 activity_id: {activity.id}, res_sql: {res.msg}")
+        counts: Dict[int, Dict[int, int]] = {}
+        for row in res.data or []:
+            counts.setdefault(int(row["user_id"]), {})[int(row["chat_id"])] = int(row["times"])
+            if row["chat_title"]:
+                self.titles[int(row["chat_id"])] = row["chat_title"]
+        return counts
+
+    async def load(self, activity: Activity) -> Dict[int, Dict[int, int]]:
+        """统计整个活动所有用户的发言次数（验证扫描前调用一次）"""
+        counts = await self._aggregate(activity)
+        self.counts.set(activity.id, counts)
+        app_logger.info(f"活动发言次数统计 activity_id: {activity.id}, 有发言用户: {len(counts)} 个")
+        return counts
+
+    async def get_user_counts(self, activity: Activity, user_id: int) -> Dict[int, int]:
+        """某用户在各群的发言次数，已加载整个活动时直接读取，否则只查这个用户"""
+        counts = self.counts.get(activity.id)
+        if counts is not None:
+            return counts.get(int(user_id), {})
+        counts = await self._aggregate(activity, int(user_id))
+        return counts.get(int(user_id), {})
+
+    def invalidate(self, activity_id: int) -> None:
+        self.counts.pop(activity_id)
+
+
+class SpeechCounterStore:
+    """发言增量计数：消息到达时按 (activity_id, user_id, chat_id) 累加；
+    后台任务定期刷新计数目标（新活动在这里初始化计数，不占用消息处理）并批量落库，停止时落库剩余增量"""
+
+    def __init__(self, repository: IDataRepository = None, flush_interval: float = 10.0, refresh_interval: float = 60.0):
+        self.repository = repository
+        self.flush_interval = flush_interval
+        self.refresh_interval = refresh_interval
+        self.pending: Counter = Counter()  # (activity_id, user_id, chat_id) -> 未落库的增量
+        self.targets: Dict[int, List[tuple]] = {}  # chat_id -> [(activity_id, start_time, end_time, 开始计数时间)]
+        self.seeded: Dict[int, datetime] = {}  # activity_id -> 开始计数时间
+        self._refreshed_at = float("-inf")
+        self._table_ready = False
+        self._task: Optional[asyncio.Task] = None
+        self._refresh_lock = asyncio.Lock()
+
+    def start(self) -> None:
+        """启动后台刷新/落库任务，已在运行时不重复启动"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh_targets()
+            except Exception as e:
+                app_logger.error(f"刷新发言计数目标失败: {e}", exc_info=True)
+            try:
+                await self.flush()
+            except Exception as e:
+                app_logger.error(f"发言计数落库异常: {e}", exc_info=True)
+            await asyncio.sleep(self.flush_interval)
+
+    async def _ensure_table(self) -> None:
+        if self._table_ready:
+            return
+        await aio_mysql.execute_sql(f"""CREATE TABLE IF NOT EXISTS {COUNTER_TABLE} (
+            activity_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            times INT NOT NULL DEFAULT 0,
+            PRIMARY KEY (activity_id, user_id, chat_id)
+        )""")
+        self._table_ready = True
+
+    async def refresh_targets(self) -> None:
+        """根据进行中的活动刷新需要计数的群；新活动先登记目标再用消息日志初始化计数，
+        初始化期间到达的消息（时间不早于开始计数时间）照常累加，不会漏掉"""
+        async with self._refresh_lock:
+            if time.monotonic() - self._refreshed_at < self.refresh_interval:
+                return
+            self.repository = self.repository or CachedRepository(InMemoryRepository())
+            activities = await self.repository.get_all_activities() or []
+            await self._ensure_table()
+            targets: Dict[int, List[tuple]] = {}
+            live_ids = set()
+            unseeded = []
+            for activity in activities:
+                groups = SpeechCountEngine.speech_groups(activity)
+                if not groups:
+                    continue
+                live_ids.add(activity.id)
+                if activity.id not in self.seeded:
+                    self.seeded[activity.id] = datetime.now()
+                    unseeded.append((activity, groups))
+                for group in groups:
+                    targets.setdefault(group, []).append((activity.id, activity.start_time, activity.end_time, self.seeded[activity.id]))
+            self.targets = targets
+            self.seeded = {activity_id: seeded_at for activity_id, seeded_at in self.seeded.items() if activity_id in live_ids}
+            for activity, groups in unseeded:
+                try:
+                    await self._seed(activity, groups, self.seeded[activity.id])
+                except Exception as e:
+                    # 没写哨兵行时读取回退到消息日志，下次刷新重新初始化
+                    self.seeded.pop(activity.id, None)
+                    app_logger.error(f"初始化发言计数异常 activity_id: {activity.id}: {e}", exc_info=True)
+            self._refreshed_at = time.monotonic()
+
+    async def _seed(self, activity: Activity, groups: List[int], seeded_at: datetime) -> None:
+        """用消息日志里 seeded_at 之前的发言初始化计数（覆盖写），之后只累加新消息"""
+        res = await aio_mysql.execute_sql(f"INSERT INTO {COUNTER_TABLE} (activity_id, user_id, chat_id, times) \
+            SELECT {activity.id}, user_id, chat_id, COUNT(*) FROM chat_messages_logs \
+            WHERE chat_id IN ({','.join(str(group) for group in groups)}) AND created_at>'{activity.start_time}' AND created_at<'{min(seeded_at, activity.end_time)}' \
+            GROUP BY user_id, chat_id ON DUPLICATE KEY UPDATE times = VALUES(times)")
+        if res.code != 200:
+            raise RuntimeError(f"初始化发言计数失败 activity_id: {activity.id}, res_sql: {res.msg}")
+        await aio_mysql.execute_sql(f"INSERT IGNORE INTO {COUNTER_TABLE} (activity_id, user_id, chat_id, times) VALUES ({activity.id}, 0, 0, 0)")
+        app_logger.info(f"初始化发言计数 activity_id: {activity.id}, seeded_at: {seeded_at}")
+
+    async def on_chat_message(self, message: dict) -> None:
+        """群消息入口：消息所在群是进行中活动的发言条件目标时累加计数，刷新目标和落库都在后台任务里做"""
+        try:
+            self.start()
+            chat = message.get("chat", {})
+            chat_id = chat.get("id")
+            user_id = message.get("from", {}).get("id")
+            if not chat_id or not user_id or chat_id not in self.targets:
+                return
+            if chat.get("title"):
+                speech_count_engine.titles[chat_id] = chat["title"]
+            sent_at = datetime.fromtimestamp(message["date"]) if message.get("date") else datetime.now()
+            for activity_id, start_time, end_time, seeded_at in self.targets[chat_id]:
+                if start_time < sent_at < end_time and sent_at >= seeded_at:
+                    self.pending[(activity_id, user_id, chat_id)] += 1
+                    verification_tracker.mark_dirty(user_id)
+        except Exception as e:
+            app_logger.error(f"发言计数异常: {e}", exc_info=True)
+
+    async def flush(self, chunk_size: int = 500) -> int:
+        """增量批量落库，失败的增量放回缓冲等待下次"""
+        pending, self.pending = self.pending, Counter()
+        if not pending:
+            return 0
+        items = list(pending.items())
+        for i in range(0, len(items), chunk_size):
+            chunk = items[i:i + chunk_size]
+            values = ",".join(f"({activity_id}, {user_id}, {chat_id}, {times})" for (activity_id, user_id, chat_id), times in chunk)
+            try:
+                res = await aio_mysql.execute_sql(f"INSERT INTO {COUNTER_TABLE} (activity_id, user_id, chat_id, times) VALUES {values} \
+                    ON DUPLICATE KEY UPDATE times = times + VALUES(times)")
+            except BaseException:
+                # 异常或任务被取消时同样放回，不丢增量
+                for key, times in items[i:]:
+                    self.pending[key] += times
+                raise
+            if res.code != 200:
+                app_logger.error(f"发言计数落库失败: res_sql: {res.msg}")
+                for key, times in items[i:]:
+                    self.pending[key] += times
+                return i
+        app_logger.info(f"发言计数落库: {len(items)} 条")
+        return len(items)
+
+    async def read(self, activity_id: int, user_id: int = None) -> Optional[Dict[int, Dict[int, int]]]:
+        """读取活动的计数（含本进程未落库的增量），计数未初始化时返回 None"""
+        user_filter = f" AND user_id IN (0, {user_id})" if user_id is not None else ""
+        res = await aio_mysql.execute_sql(f"SELECT user_id, chat_id, times FROM {COUNTER_TABLE} WHERE activity_id = {activity_id}{user_filter}")
+        if res.code != 200 or not res.data:
+            return None
+        counts: Dict[int, Dict[int, int]] = {}
+        initialized = False
+        for row in res.data:
+            if not row["user_id"] and not row["chat_id"]:
+                initialized = True
+                continue
+            counts.setdefault(int(row["user_id"]), {})[int(row["chat_id"])] = int(row["times"])
+        if not initialized:
+            return None
+        for (pending_activity_id, pending_user_id, chat_id), times in self.pending.items():
+            if pending_activity_id == activity_id and (user_id is None or pending_user_id == int(user_id)):
+                user_counts = counts.setdefault(pending_user_id, {})
+                user_counts[chat_id] = user_counts.get(chat_id, 0) + times
+        return counts
+
+    async def close(self) -> None:
+        """停止后台任务并落库剩余增量"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+
+# 进程内共享的发言次数统计
+speech_count_engine = SpeechCountEngine()
+speech_counter_store = SpeechCounterStore()
+
+
+async def speech_count_ingest(message):
+    """群消息计数入口，由 lottery_activity.group_message_func 调用；
+    计数初始化（哨兵行写入）后 read() 只信任计数表，所有群消息都要经过这里，否则发言次数会偏少"""
+    await speech_counter_store.on_chat_message(message)
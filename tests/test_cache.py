@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+import pytest
+
+from app.lottery_activity_handler.cache import TTLCache
+from app.lottery_activity_handler.singleflight import SingleFlight
+
+
+def test_ttl_cache_expires_entries():
+    cache = TTLCache(maxsize=10, ttl=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2, ttl=10)
+    assert cache.get("a") == 1
+    time.sleep(0.06)
+    assert cache.get("a") is None
+    assert cache.peek("a") is None
+    assert cache.get("b") == 2
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 1
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.keys() == ["a", "c"]
+    # peek 不刷新顺序
+    cache.peek("a")
+    cache.set("d", 4)
+    assert cache.keys() == ["c", "d"]
+    assert cache.pop("c") == 3 and len(cache) == 1
+
+
+def test_singleflight_coalesces_concurrent_calls():
+    async def main():
+        flight = SingleFlight()
+        calls = 0
+
+        async def load():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.01)
+            return calls
+
+        results = await asyncio.gather(*[flight.do("key", load) for _ in range(10)])
+        assert results == [1] * 10
+        assert calls == 1
+        # 请求完成后不再复用旧结果
+        assert await flight.do("key", load) == 2
+        assert flight.stats() == {"inflight": 0, "calls": 2, "coalesced": 9, "coalesce_rate": 0.8182}
+
+    asyncio.run(main())
+
+
+def test_singleflight_shares_errors_and_survives_cancelled_waiter():
+    async def main():
+        flight = SingleFlight()
+        started = asyncio.Event()
+
+        async def fail():
+            started.set()
+            await asyncio.sleep(0.01)
+            raise ValueError("boom")
+
+        waiter = asyncio.ensure_future(flight.do("key", fail))
+        await started.wait()
+        other = asyncio.ensure_future(flight.do("key", fail))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(ValueError):
+            await other
+        assert flight.stats()["inflight"] == 0
+
+    asyncio.run(main())
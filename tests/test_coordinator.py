@@ -0,0 +1,107 @@
+import asyncio
+
+from app.lottery_activity_handler.coordinator import LeaderCoordinator, ShardedCoordinator, SQLiteLeaseBackend
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_sqlite_lease_is_exclusive_until_expired():
+    async def main():
+        backend = SQLiteLeaseBackend()
+        assert await backend.acquire_lease("lease", "a", 0.1)
+        assert not await backend.acquire_lease("lease", "b", 0.1)
+        # 持有者续约
+        assert await backend.acquire_lease("lease", "a", 0.1)
+        await asyncio.sleep(0.15)
+        assert await backend.acquire_lease("lease", "b", 0.1)
+        assert not await backend.acquire_lease("lease", "a", 0.1)
+
+    run(main())
+
+
+def test_sqlite_release_only_by_holder():
+    async def main():
+        backend = SQLiteLeaseBackend()
+        assert await backend.acquire_lease("lease", "a", 10)
+        await backend.release_lease("lease", "b")
+        assert not await backend.acquire_lease("lease", "b", 10)
+        await backend.release_lease("lease", "a")
+        assert await backend.acquire_lease("lease", "b", 10)
+
+    run(main())
+
+
+def test_sqlite_live_nodes():
+    async def main():
+        backend = SQLiteLeaseBackend()
+        await backend.heartbeat("b")
+        await backend.heartbeat("a")
+        assert await backend.live_nodes(10) == ["a", "b"]
+        await backend.leave("a")
+        assert await backend.live_nodes(10) == ["b"]
+
+    run(main())
+
+
+def test_claim_is_renewed_while_running():
+    async def main():
+        backend = SQLiteLeaseBackend()
+        first = ShardedCoordinator(backend, node_id="a", claim_ttl=0.3)
+        second = ShardedCoordinator(backend, node_id="b", claim_ttl=0.3)
+        assert await first.claim("end:1")
+        # 执行时间超过 claim_ttl，续约后其他节点仍然抢不到
+        await asyncio.sleep(0.7)
+        assert not await second.claim("end:1")
+        await first.finish("end:1", True)
+        # 成功后不再续约，过期前仍然保留
+        assert not await second.claim("end:1")
+        await asyncio.sleep(0.35)
+        assert await second.claim("end:1")
+        await second.finish("end:1", True)
+
+    run(main())
+
+
+def test_failed_claim_is_released_for_retry():
+    async def main():
+        backend = SQLiteLeaseBackend()
+        first = ShardedCoordinator(backend, node_id="a", claim_ttl=60)
+        second = ShardedCoordinator(backend, node_id="b", claim_ttl=60)
+        assert await first.claim("end:1")
+        assert not await second.claim("end:1")
+        await first.finish("end:1", False)
+        assert await second.claim("end:1")
+        await second.stop()
+
+    run(main())
+
+
+def test_leader_election():
+    async def main():
+        backend = SQLiteLeaseBackend()
+        first = LeaderCoordinator(backend, node_id="a", ttl=30)
+        second = LeaderCoordinator(backend, node_id="b", ttl=30)
+        await first.refresh()
+        await second.refresh()
+        assert first.owns(1) and not second.owns(1)
+        await first.stop()
+        await second.refresh()
+        assert second.owns(1)
+
+    run(main())
+
+
+def test_sharded_owner_is_unique():
+    async def main():
+        backend = SQLiteLeaseBackend()
+        nodes = [ShardedCoordinator(backend, node_id=node_id) for node_id in ("a", "b", "c")]
+        for node in nodes:
+            await node.refresh()
+        for node in nodes:
+            await node.refresh()
+        for activity_id in range(100):
+            assert sum(node.owns(activity_id) for node in nodes) == 1
+
+    run(main())
@@ -0,0 +1,63 @@
+import random
+from collections import Counter
+
+from app.lottery_activity_handler.draw_engine import AliasSampler, DrawEngine
+
+
+def test_same_seed_replays_the_draw():
+    first = DrawEngine(seed=12345).draw(1000, [1, 5, 20])
+    second = DrawEngine(seed=12345).draw(1000, [1, 5, 20])
+    assert first == second
+    assert DrawEngine(seed=54321).draw(1000, [1, 5, 20]) != first
+
+
+def test_tiers_are_disjoint_and_sized():
+    tiers = DrawEngine(seed=1).draw(100, [3, 10, 30])
+    assert [len(tier) for tier in tiers] == [3, 10, 30]
+    picked = [index for tier in tiers for index in tier]
+    assert len(picked) == len(set(picked))
+    assert all(0 <= index < 100 for index in picked)
+
+
+def test_draw_stops_when_candidates_run_out():
+    tiers = DrawEngine(seed=1).draw(5, [2, 2, 2])
+    assert [len(tier) for tier in tiers] == [2, 2, 1]
+    assert sorted(index for tier in tiers for index in tier) == [0, 1, 2, 3, 4]
+    assert DrawEngine(seed=1).draw(0, [1]) == [[]]
+
+
+def test_alias_sampler_follows_weights():
+    rng = random.Random(7)
+    weights = [1.0, 2.0, 7.0]
+    counts = Counter(AliasSampler(weights, rng).pick(1)[0] for _ in range(20000))
+    for index, weight in enumerate(weights):
+        assert abs(counts[index] / 20000 - weight / sum(weights)) < 0.02
+
+
+def test_alias_sampler_without_replacement():
+    sampler = AliasSampler([5.0, 0.0, 1.0, 3.0], random.Random(3))
+    picked = sampler.pick(10)
+    assert sorted(picked) == [0, 1, 2, 3]
+    # 权重为 0 的只在其他人都抽完后才会被抽到
+    assert picked[-1] == 1
+    assert sampler.pick(1) == []
+
+
+def test_samplers_share_taken_across_prizes():
+    engine = DrawEngine(seed=99)
+    taken = set()
+    population = 50
+    first = engine.weighted_sampler([index + 1.0 for index in range(population)], taken).pick(20)
+    second = engine.weighted_sampler([1.0] * population, taken).pick(40)
+    assert len(first) == 20 and len(second) == 30
+    assert not set(first) & set(second)
+    assert taken == set(range(population))
+
+
+def test_weighted_draw_replays_with_seed():
+    def run(seed):
+        engine = DrawEngine(seed=seed)
+        taken = set()
+        return [engine.weighted_sampler([float(index % 7) for index in range(200)], taken).pick(count) for count in (1, 5, 10)]
+
+    assert run(2024) == run(2024)
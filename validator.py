@@ -1,9 +1,16 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
 from abc import ABC, abstractmethod
-from typing import Dict
-from mysql.aio import aio_mysql
+from typing import Awaitable, Callable, Dict, List, Optional
+from telegram import Bot
 from helper import *
+from app.lottery_activity_handler.cache import TTLCache
+from app.lottery_activity_handler.singleflight import SingleFlight
 from app.lottery_activity_handler.data_class import ConditionType, LotteryBot
-from app.lottery_activity_handler.data_repository import IDataRepository
+from app.lottery_activity_handler.data_repository import IDataRepository, ConditionStatusWriter
+from app.lottery_activity_handler.speech_count import speech_count_engine
+from app.lottery_activity_handler.verification import verification_tracker
 from app.lottery_activity_handler.logger_handler import app_logger
 
 
@@ -15,17 +22,60 @@ class IConditionValidator(ABC):
         """验证用户是否满足条件"""
         pass
 
+class MembershipCache:
+    """getChatMember 结果缓存，按 (chat_id, user_id) 跨活动、跨处理器共享；不是成员的结果过期更快"""
+    
+    MEMBER_STATUSES = ('member', 'administrator', 'creator')
+    
+    def __init__(self, positive_ttl: float = 300.0, negative_ttl: float = 10.0):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.entries = TTLCache(maxsize=200000, ttl=positive_ttl)
+        self.flight = SingleFlight()  # 同一个 (群, 用户) 的并发查询只请求一次
+    
+    async def is_member(self, chat_id, user_id, get_bot: Callable[[], Awaitable[Bot]]) -> bool:
+        """缓存未命中时才取机器人并请求 Telegram"""
+        key = (str(chat_id), int(user_id))
+        is_member = self.entries.get(key)
+        if is_member is not None:
+            return is_member
+        return await self.flight.do(key, lambda: self._fetch(key, chat_id, user_id, get_bot))
+    
+    async def _fetch(self, key: tuple, chat_id, user_id, get_bot: Callable[[], Awaitable[Bot]]) -> bool:
+        bot = await get_bot()
+        member = await bot.get_chat_member(chat_id, user_id)
+        is_member = member.status in self.MEMBER_STATUSES
+        self.entries.set(key, is_member, ttl=self.positive_ttl if is_member else self.negative_ttl)
+        return is_member
+    
+    def invalidate(self, chat_id, user_id) -> None:
+        """收到用户进出群事件时调用"""
+        self.entries.pop((str(chat_id), int(user_id)))
+        verification_tracker.mark_dirty(user_id)
+    
+    def stats(self) -> Dict:
+        return {**self.entries.stats(), "singleflight": self.flight.stats()}
+
+
+# 进程内共享的成员关系缓存
+membership_cache = MembershipCache()
+
+
 class JoinGroupValidator(IConditionValidator):
     """加群条件验证器"""
     
     async def validate(self, user_id: str, *args) -> bool:
         try:
-            condition, bot, sys_user_id = args
+            condition, bot, sys_user_id = args[:3]
+            session = args[3] if len(args) > 3 else None
             app_logger.info(f"加群组条件验证 参数: target_id: {condition.target_id}, type: {condition.type.value}, sys_user_id: {sys_user_id}")
-            bot = await LotteryBot.get_first_bot(condition.target_id, condition.type.value, sys_user_id)
-            member = await bot.get_chat_member(condition.target_id, user_id)
-            app_logger.info(f"加群组条件验证 结果: target_id: {condition.target_id}, type: {condition.type.value}, sys_user_id: {sys_user_id}, res: {member}")
-            return member.status in ['member', 'administrator', 'creator']
+            is_member = await membership_cache.is_member(
+                condition.target_id, user_id,
+                (lambda: session.first_bot(condition)) if session else
+                (lambda: LotteryBot.get_first_bot(condition.target_id, condition.type.value, sys_user_id))
+            )
+            app_logger.info(f"加群组条件验证 结果: target_id: {condition.target_id}, type: {condition.type.value}, sys_user_id: {sys_user_id}, res: {is_member}")
+            return is_member
         except Exception as e:
             app_logger.error(f"验证群组条件失败: {e}", exc_info=True)
             return False
@@ -36,30 +86,87 @@ class JoinChannelValidator(IConditionValidator):
     
     async def validate(self, user_id: str, *args) -> bool:
         try:
-            condition, bot, sys_user_id = args
+            condition, bot, sys_user_id = args[:3]
+            session = args[3] if len(args) > 3 else None
             app_logger.info(f"加频道条件验证 参数: target_id: {condition.target_id}, type: {condition.type.value}, sys_user_id: {sys_user_id}")
-            bot = await LotteryBot.get_first_bot(condition.target_id, condition.type.value, sys_user_id)
-            member = await bot.get_chat_member(condition.target_id, user_id)
-            app_logger.info(f"加频道条件验证 结果: target_id: {condition.target_id}, type: {condition.type.value}, sys_user_id: {sys_user_id}, res: {member}")
-            return member.status in ['member', 'administrator', 'creator']
+            is_member = await membership_cache.is_member(
+                condition.target_id, user_id,
+                (lambda: session.first_bot(condition)) if session else
+                (lambda: LotteryBot.get_first_bot(condition.target_id, condition.type.value, sys_user_id))
+            )
+            app_logger.info(f"加频道条件验证 结果: target_id: {condition.target_id}, type: {condition.type.value}, sys_user_id: {sys_user_id}, res: {is_member}")
+            return is_member
         except Exception as e:
             app_logger.error(f"验证加频道条件失败: {e}", exc_info=True)
             return False
 
 
 class FollowBotValidator(IConditionValidator):
-    """关注机器人条件验证器"""
+    """关注机器人条件验证器：查询在线程池执行不阻塞事件循环；扫描时可按页批量预取结果"""
+    
+    # 外部同步 helper 不保证线程安全，所有实例共用一个单线程执行器，查询串行执行
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="follow_bot")
+    CHUNK_SIZE = 100  # 每次提交给执行器的用户数，大批量扫描/开奖分块提交，用户点击检查的查询可以插队执行
+    
+    def __init__(self, positive_ttl: float = 60.0, negative_ttl: float = 10.0):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl  # 未关注的结果过期更快，用户关注后很快能重新验证通过
+        self.results = TTLCache(maxsize=200000, ttl=positive_ttl)  # (target_id, sys_user_id, user_id) -> 是否关注
+    
+    @staticmethod
+    def _check_many(target_id, user_ids: List[int], sys_user_id) -> Dict[int, Optional[bool]]:
+        """在工作线程里依次调用同步的 helper，一页只占用一次线程切换；单个用户查询失败记为 None，不影响其他用户"""
+        results = {}
+        for user_id in user_ids:
+            try:
+                results[user_id] = bool(check_users_follow_bots(target_id, user_id, sys_user_id))
+            except Exception as e:
+                app_logger.error(f"关注机器人条件查询失败 target_id: {target_id}, sys_user_id: {sys_user_id}, tg_user_id: {user_id}: {e}")
+                results[user_id] = None
+        return results
+    
+    async def validate_many(self, condition, user_ids: List[int], sys_user_id) -> Dict[int, Optional[bool]]:
+        """批量验证一批用户，未缓存的用户一次性交给工作线程查询；查询失败的用户结果为 None 且不缓存"""
+        results = {}
+        missing = []
+        for user_id in user_ids:
+            res = self.results.get((condition.target_id, sys_user_id, int(user_id)))
+            if res is None:
+                missing.append(int(user_id))
+            else:
+                results[int(user_id)] = res
+        if missing:
+            loop = asyncio.get_running_loop()
+            checked = {}
+            for start in range(0, len(missing), self.CHUNK_SIZE):
+                checked.update(await loop.run_in_executor(self._executor, self._check_many, condition.target_id, missing[start:start + self.CHUNK_SIZE], sys_user_id))
+            for user_id, res in checked.items():
+                if res is not None:
+                    self.results.set((condition.target_id, sys_user_id, user_id), res, ttl=self.positive_ttl if res else self.negative_ttl)
+            results.update(checked)
+            app_logger.info(f"关注机器人条件批量验证 target_id: {condition.target_id}, sys_user_id: {sys_user_id}, 查询: {len(missing)}, 命中缓存: {len(user_ids) - len(missing)}, 通过: {sum(1 for res in checked.values() if res)}, 失败: {sum(1 for res in checked.values() if res is None)}")
+        return results
     
     async def validate(self, user_id: str, *args) -> bool:
         try:
-            condition, bot, sys_user_id = args
+            condition, bot, sys_user_id = args[:3]
             app_logger.info(f"关注机器人条件验证 参数: target_id: {condition.target_id}, type: {condition.type.value}, sys_user_id: {sys_user_id}, tg_user_id: {user_id}")
-            res = check_users_follow_bots(condition.target_id, user_id, sys_user_id)
+            res = (await self.validate_many(condition, [int(user_id)], sys_user_id))[int(user_id)]
             app_logger.info(f"关注机器人条件验证 结果: target_id: {condition.target_id}, type: {condition.type.value}, sys_user_id: {sys_user_id}, tg_user_id: {user_id}, res: {res}")
-            if res:return True
+            return bool(res)
         except Exception as e:
             app_logger.error(f"验证关注机器人条件失败: {e}", exc_info=True)
             return False
+    
+    def invalidate(self, user_id=None) -> None:
+        """用户关注/取关机器人后调用，不传 user_id 时清空全部"""
+        if user_id is None:
+            self.results.clear()
+            return
+        verification_tracker.mark_dirty(user_id)
+        for key in self.results.keys():
+            if key[2] == int(user_id):
+                self.results.pop(key)
 
 class SpeechCountValidator(IConditionValidator):
     """发言次数条件验证器"""
@@ -67,25 +174,124 @@ class SpeechCountValidator(IConditionValidator):
     async def validate(self, user_id: str, *args) -> bool:
         try:
             activity = args[0]
+            session = args[1] if len(args) > 1 else None
+            counts = await session.user_speech_counts(user_id) if session else await speech_count_engine.get_user_counts(activity, user_id)
             for condition in activity.conditions:
                 if condition.type.value == "speech_count":
                     groups = condition.target_id.split(',')
                     for group in groups:
-                        activities_reply_data = await aio_mysql.execute_sql(f"SELECT * FROM chat_messages_logs WHERE user_id={user_id} AND chat_id={group} AND created_at>'{activity.start_time}' AND created_at<'{activity.end_time}'")
-                        if activities_reply_data.code == 200 and activities_reply_data.data:
-                            times = len(activities_reply_data.data)
-                        else:
-                            times = 0
+                        times = counts.get(int(group), 0)
                         app_logger.info(f"这个群发言次数验证: group: {group}, start_time: '{activity.start_time}', end_time: '{activity.end_time}', tg_user_id: {user_id}, 目标次数: {condition.target_id_link}, 当前次数: {times}")
                         if times < int(condition.target_id_link):
                             return False
-            app_logger.info(f"群发言次数验证 结果: groups: '{groups}', start_time: '{activity.start_time}', end_time: '{activity.end_time}', tg_user_id: {user_id}, 目标次数: {condition.target_id_link}, 当前次数: {times}")
+            app_logger.info(f"群发言次数验证 结果: start_time: '{activity.start_time}', end_time: '{activity.end_time}', tg_user_id: {user_id}, 当前次数: {counts}")
             return True
         except Exception as e:
             app_logger.error(f"验证发言次数条件失败: {e}", exc_info=True)
             return False
         
 
+class ValidationSession:
+    """一次扫描的验证上下文：活动只加载一次，群/频道机器人、发言统计和批量写入在整轮扫描内共用"""
+    
+    def __init__(self, activity, bot, writer: ConditionStatusWriter = None):
+        self.activity = activity
+        self.bot = bot
+        self.sys_user_id = activity.sys_user_id
+        self.writer = writer
+        self.bots: Dict[tuple, Bot] = {}  # (目标群/频道, 类型) -> 机器人
+        self.speech_counts: Optional[Dict[int, Dict[int, int]]] = None  # 整个活动的发言次数，整轮扫描内有效
+    
+    @classmethod
+    async def open(cls, repository: IDataRepository, activity_id, bot, writer: ConditionStatusWriter = None, preload: bool = True) -> "ValidationSession":
+        """加载活动，扫描时（preload）预先聚合整个活动的发言次数保存在上下文里；活动不存在返回 None"""
+        activity = await repository.get_activity_by_id(activity_id)
+        if not activity:
+            return None
+        session = cls(activity, bot, writer)
+        if preload and speech_count_engine.speech_groups(activity):
+            await session.load_speech_counts()
+        return session
+    
+    async def load_speech_counts(self) -> Dict[int, Dict[int, int]]:
+        """整个活动的发言次数，本轮扫描只聚合一次，不受全局缓存过期影响"""
+        if self.speech_counts is None:
+            self.speech_counts = await speech_count_engine.load(self.activity)
+        return self.speech_counts
+    
+    async def user_speech_counts(self, user_id) -> Dict[int, int]:
+        """已加载整个活动时直接读取，否则（用户点击检查）只查这个用户"""
+        if self.speech_counts is not None:
+            return self.speech_counts.get(int(user_id), {})
+        return await speech_count_engine.get_user_counts(self.activity, user_id)
+    
+    async def first_bot(self, condition) -> Bot:
+        key = (condition.target_id, condition.type.value)
+        bot = self.bots.get(key)
+        if bot is None:
+            bot = self.bots[key] = await LotteryBot.get_first_bot(condition.target_id, condition.type.value, self.sys_user_id)
+        return bot
+    
+    def close(self) -> None:
+        """发言统计只在本轮扫描内有效"""
+        self.speech_counts = None
+        speech_count_engine.invalidate(self.activity.id)
+
+
+class ConditionStats:
+    """按条件类型统计验证耗时和通过率（指数滑动平均），用于决定验证顺序"""
+    
+    # 没有统计数据前的初始估计：发言次数读内存聚合，关注机器人查库，加群/频道请求 Telegram
+    PRIOR_LATENCY = {
+        ConditionType.SPEECH_COUNT: 0.001,
+        ConditionType.FOLLOW_BOT: 0.01,
+        ConditionType.JOIN_GROUP: 0.2,
+        ConditionType.JOIN_CHANNEL: 0.2,
+    }
+    
+    def __init__(self, alpha: float = 0.05):
+        self.alpha = alpha
+        self.latency: Dict[ConditionType, float] = dict(self.PRIOR_LATENCY)
+        self.pass_rate: Dict[ConditionType, float] = {}
+        self.calls: Dict[ConditionType, int] = {}
+    
+    def record(self, condition_type: ConditionType, elapsed: float, passed: bool) -> None:
+        latency = self.latency.get(condition_type, elapsed)
+        pass_rate = self.pass_rate.get(condition_type, 0.5)
+        self.latency[condition_type] = latency + self.alpha * (elapsed - latency)
+        self.pass_rate[condition_type] = pass_rate + self.alpha * ((1.0 if passed else 0.0) - pass_rate)
+        self.calls[condition_type] = self.calls.get(condition_type, 0) + 1
+    
+    def record_batch(self, condition_type: ConditionType, elapsed: float, checked: int, passed: int) -> None:
+        """批量验证按平均每人耗时和通过比例记录"""
+        if not checked:
+            return
+        latency = self.latency.get(condition_type, elapsed / checked)
+        pass_rate = self.pass_rate.get(condition_type, 0.5)
+        self.latency[condition_type] = latency + self.alpha * (elapsed / checked - latency)
+        self.pass_rate[condition_type] = pass_rate + self.alpha * (passed / checked - pass_rate)
+        self.calls[condition_type] = self.calls.get(condition_type, 0) + checked
+    
+    def rank(self, condition_type: ConditionType) -> float:
+        """耗时 / 失败概率，越小越先验证：便宜且容易失败的条件排在前面"""
+        latency = self.latency.get(condition_type, 0.0)
+        fail_rate = 1.0 - self.pass_rate.get(condition_type, 0.5)
+        return latency / max(fail_rate, 0.01)
+    
+    def order(self, conditions: List) -> List:
+        return sorted(conditions, key=lambda condition: self.rank(condition.type))
+    
+    def stats(self) -> Dict:
+        return {
+            condition_type.value: {
+                "latency": round(self.latency.get(condition_type, 0.0), 4),
+                "pass_rate": round(self.pass_rate.get(condition_type, 0.5), 4),
+                "calls": calls
+            }
+            for condition_type, calls in self.calls.items()
+        }
+
+
 class ConditionValidatorFactory:
     """条件验证器工厂"""
     
@@ -96,51 +302,86 @@ class ConditionValidatorFactory:
         ConditionType.SPEECH_COUNT: SpeechCountValidator(),
     }
     
+    condition_stats = ConditionStats()
+    
     @classmethod
     def get_validator(cls, condition_type: ConditionType) -> IConditionValidator:
         return cls._validators.get(condition_type)
     
-    async def validate_user_conditions(self, repository: IDataRepository, user_id: str, activity_id: str, bot, sys_user_id) -> Dict:
-        """验证用户条件完成情况"""
+    async def _validate_condition(self, condition, session: ValidationSession, user_id) -> bool:
+        """验证单个条件并记录耗时和结果"""
+        validator = ConditionValidatorFactory.get_validator(condition.type)
+        started_at = time.monotonic()
+        if condition.type.value != "speech_count":
+            is_verified = await validator.validate(user_id, condition, session.bot, session.sys_user_id, session)
+        else:
+            is_verified = await validator.validate(user_id, session.activity, session)
+        self.condition_stats.record(condition.type, time.monotonic() - started_at, bool(is_verified))
+        return bool(is_verified)
+    
+    async def prefetch(self, activity, user_ids: List[int]) -> None:
+        """扫描时按页预取支持批量验证的条件，后续逐个用户验证直接命中缓存"""
+        for condition in activity.conditions:
+            validator = ConditionValidatorFactory.get_validator(condition.type)
+            if isinstance(validator, FollowBotValidator):
+                try:
+                    await validator.validate_many(condition, user_ids, activity.sys_user_id)
+                except Exception as e:
+                    app_logger.error(f"批量预取关注机器人条件失败: {e}", exc_info=True)
+    
+    async def validate_user_conditions(self, repository: IDataRepository, user_id: str, activity_id: str, bot, sys_user_id, writer: ConditionStatusWriter = None, short_circuit: bool = False) -> Dict:
+        """验证用户条件完成情况（单个用户，如用户点击检查），传入 writer 时状态缓冲到批量写入"""
         try:
-            activity = await repository.get_activity_by_id(activity_id)
             app_logger.info(f"验证用户条件完成情况 参数 user_id: {user_id}, activity_id: {activity_id}")
-            if not activity:
+            session = await ValidationSession.open(repository, activity_id, bot, writer, preload=False)
+            if not session:
                 app_logger.info(f"验证用户条件完成情况 活动不存在 user_id: {user_id}, activity_id: {activity_id}")
                 return {"error": "活动不存在"}
-            
+            return await self.validate_in_session(repository, session, user_id, short_circuit)
+        except Exception as e:
+            app_logger.error(f"验证用户条件完成情况 异常: {e}", exc_info=True)
+            return {"error": str(e)}
+    
+    async def validate_in_session(self, repository: IDataRepository, session: ValidationSession, user_id, short_circuit: bool = False) -> Dict:
+        """在扫描上下文内验证用户条件，只读取上下文里的活动和机器人；
+        short_circuit 用于扫描/开奖：按统计的耗时和失败率排序依次验证，遇到不满足的条件即停止；
+        否则（用户点击检查）所有条件并发验证，返回每个条件的结果"""
+        try:
+            activity = session.activity
+            started_at = time.monotonic()
             results = {}
-            all_verified = True
-            
-            for condition in activity.conditions:
-                validator = ConditionValidatorFactory.get_validator(condition.type)
-                if validator and condition.type.value != "speech_count":
-                    is_verified = await validator.validate(user_id, condition, bot, sys_user_id)
-                    results[condition.type.value] = {
-                        "type": condition.type.value,
-                        "button_name": condition.button_name,
-                        "verified": is_verified
-                    }
-                    if not is_verified:
-                        all_verified = False
-                else:
-                    is_verified = await validator.validate(user_id, activity)
-                    results[condition.type.value] = {
-                        "type": condition.type.value,
-                        "button_name": condition.button_name,
-                        "verified": is_verified
-                    }
+            conditions = [condition for condition in activity.conditions if ConditionValidatorFactory.get_validator(condition.type)]
+            if short_circuit:
+                verified = []
+                for condition in self.condition_stats.order(conditions):
+                    is_verified = await self._validate_condition(condition, session, user_id)
+                    verified.append((condition, is_verified))
                     if not is_verified:
-                        all_verified = False
+                        break
+            else:
+                verified = list(zip(conditions, await asyncio.gather(*[
+                    self._validate_condition(condition, session, user_id)
+                    for condition in conditions
+                ])))
+            for condition, is_verified in verified:
+                results[condition.type.value] = {
+                    "type": condition.type.value,
+                    "button_name": condition.button_name,
+                    "verified": is_verified
+                }
+            # 短路时后面未验证的条件不在 results 里
+            all_verified = len(verified) == len(conditions) and all(is_verified for _, is_verified in verified)
             
-            if all_verified:
-                res_sql = await repository.update_activity_detail(activity.id, user_id, 1)
+            if session.writer:
+                session.writer.add(activity.id, user_id, 1 if all_verified else 0)
             else:
-                res_sql = await repository.update_activity_detail(activity.id, user_id, 0)
+                res_sql = await repository.update_activity_detail(activity.id, user_id, 1 if all_verified else 0)
+                verification_tracker.record(activity.id, user_id, all_verified, started_at)
             app_logger.info(f"验证用户条件完成情况 结果: user_id: {user_id}, all_verified: {all_verified}, conditions: {results}")
             return {
                 "all_verified": all_verified,
-                "conditions": results
+                "conditions": results,
+                "started_at": started_at
             }
         except Exception as e:
             app_logger.error(f"验证用户条件完成情况 异常: {e}", exc_info=True)
@@ -0,0 +1,50 @@
+import time
+from typing import Dict, Optional, Tuple
+
+from app.lottery_activity_handler.cache import TTLCache
+
+
+class VerificationTracker:
+    """记录每个活动里用户最近一次条件验证的时间和结果，增量扫描只重新验证过期或被标记变化的用户"""
+
+    def __init__(self, dirty_ttl: float = 3600.0):
+        self.verified: Dict[int, Dict[int, Tuple[float, bool]]] = {}  # 活动id -> 用户id -> (验证时间, 结果)
+        # 用户id -> 最近一次相关事件的时间；过期时间要大于扫描用的新鲜度窗口
+        self.dirty = TTLCache(maxsize=200000, ttl=dirty_ttl)
+
+    def fresh_result(self, activity_id, user_id, freshness: float, now: Optional[float] = None) -> Optional[bool]:
+        """仍然有效的上次验证结果；从未验证、结果超过 freshness 秒、或验证之后发生过相关事件时返回 None"""
+        record = self.verified.get(int(activity_id), {}).get(int(user_id))
+        if record is None:
+            return None
+        verified_at, result = record
+        now = time.monotonic() if now is None else now
+        if now - verified_at > freshness:
+            return None
+        dirty_at = self.dirty.peek(int(user_id))
+        if dirty_at is not None and dirty_at >= verified_at:
+            return None
+        return result
+
+    def needs_check(self, activity_id, user_id, freshness: float, now: Optional[float] = None) -> bool:
+        return self.fresh_result(activity_id, user_id, freshness, now) is None
+
+    def record(self, activity_id, user_id, result: bool, verified_at: float) -> None:
+        """verified_at 用验证开始的时间，验证过程中发生的事件会让下次扫描重新验证"""
+        self.verified.setdefault(int(activity_id), {})[int(user_id)] = (verified_at, bool(result))
+
+    def mark_dirty(self, user_id) -> None:
+        """用户发言、进出群、关注机器人等事件后调用"""
+        self.dirty.set(int(user_id), time.monotonic())
+
+    def forget(self, activity_id) -> None:
+        """活动结束后清理"""
+        self.verified.pop(int(activity_id), None)
+
+    def stats(self, activity_id) -> Dict:
+        records = self.verified.get(int(activity_id), {})
+        return {"verified": len(records), "passed": sum(1 for _, result in records.values() if result), "dirty": len(self.dirty)}
+
+
+# 进程内共享的验证记录
+verification_tracker = VerificationTracker()